@@ -1,161 +1,720 @@
-from vmbpy import *
-from spectral import *
+from __future__ import annotations
+import os
+import math
+import time
 import numpy as np
 import DM542t as Driver
-from PyQt5.QtCore import QObject, pyqtSignal, QCoreApplication
+from acquisition import FramePool, ScanCube, ScanPipeline, unpackMono10p, unpackMono12p
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+
+# vmbpy is imported inside the functions that need it, so importing this module
+# (and starting the GUI) doesn't wait on the Vimba runtime
+
+class CameraSession:
+    '''
+    Keeps the Vimba system and the first camera open for as long as the session
+    lives, so every Camera call reuses the same handle instead of paying the
+    GigE/USB open cost again. Feature objects are looked up once and cached.
+    Can be used explicitly (open/close) or as a context manager.
+    '''
+    def __init__(self, index=0) -> None:
+        self.index = index
+        self.vmb = None
+        self.cam = None
+        self.features = {}
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, excType, excValue, traceback) -> None:
+        self.close()
+
+    def isOpen(self) -> bool:
+        return self.cam is not None
+
+    def open(self):
+        if self.cam is not None:
+            return self.cam
+        from vmbpy import VmbSystem
+        vmb = VmbSystem.get_instance()
+        vmb.__enter__()
+        try:
+            cams = vmb.get_all_cameras()
+            if len(cams) <= self.index:
+                raise RuntimeError('No camera found at index ' + str(self.index))
+            cam = cams[self.index]
+            cam.__enter__()
+        except BaseException:
+            vmb.__exit__(None, None, None)
+            raise
+        self.vmb = vmb
+        self.cam = cam
+        return self.cam
+
+    def close(self) -> None:
+        self.features = {}
+        if self.cam is not None:
+            try:
+                self.cam.__exit__(None, None, None)
+            finally:
+                self.cam = None
+                self.vmb.__exit__(None, None, None)
+                self.vmb = None
+
+    def camera(self):
+        # opens on first use, afterwards just hands back the warm handle
+        return self.open()
+
+    def feature(self, name):
+        if name not in self.features:
+            self.features[name] = self.camera().get_feature_by_name(name)
+        return self.features[name]
+
+# one session shared by every Camera object for the application lifetime
+_session = None
+# 'hardware' for the real camera, 'sim' for simulation.SimulatedCamera
+_backend = os.environ.get('SPECTROMETER_BACKEND', 'hardware')
+
+def setBackend(backend) -> None:
+    global _backend
+    if backend not in ('hardware', 'sim'):
+        raise ValueError('Unknown camera backend: ' + backend)
+    if backend != _backend:
+        closeSession()
+        _backend = backend
+
+def getSession() -> CameraSession:
+    global _session
+    if _session is None:
+        if _backend == 'sim':
+            import simulation
+            _session = simulation.SimulatedSession()
+        else:
+            _session = CameraSession()
+    return _session
+
+def closeSession() -> None:
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
+
+# snaps value onto the feature's increment grid, rounding down unless roundUp
+def snapToIncrement(feature, value, roundUp=False) -> int:
+    low, high = feature.get_range()
+    inc = feature.get_increment()
+    steps = (value - low) // inc
+    if roundUp and low + steps * inc < value:
+        steps += 1
+    return int(min(low + steps * inc, high))
 
 class Camera(QObject):
     progressChanged = pyqtSignal(int)
     cancelledChanged = pyqtSignal(bool)
+    # step index and its averaged rows x columns frame, once it is in the cube
+    stepReady = pyqtSignal(int, object)
 
-    def __init__(self) -> None:
+    def __init__(self, session=None) -> None:
         super().__init__()
         self.cancelled = False
         self.imagesPerStep = 1
+        self.session = session if session is not None else getSession()
+        self.gainConfigured = False
+        # stream frames through a recycled buffer pool instead of get_frame() per image
+        self.streaming = True
+        self.bufferCount = 8
+        self.lastScanStats = {}
+        # per pixel SNR of every step, only tracked when imagesPerStep >= 2
+        self.trackSNR = True
+        self.lastSNR = None
+        # slack on the scan plan dwell and releases for the latency of the arrival
+        # report, which makes the host see every arrival that much late
+        self.planDwellMargin = 0.001
+        # continuous motion instead of stop and stare, see scanContinuous
+        self.continuous = False
+        self.lastFrameAngles = None
 
     def setIntegrationTime(self, integrationTime) -> None:
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                features = cam.get_all_features()
-                for feature in features:
-                    if feature.get_name() == 'Gain':
-                        feature.set(1)
-                    if feature.get_name() == 'GainAuto':
-                        feature.set(False)
-                exposure_time = cam.ExposureTime
+        from vmbpy import VmbFeatureError
+        if not self.gainConfigured:
+            # gain only has to be pinned once per session, not on every call
+            for name, value in (('Gain', 1), ('GainAuto', False)):
+                try:
+                    self.session.feature(name).set(value)
+                except VmbFeatureError:
+                    pass
+            self.gainConfigured = True
+        exposure_time = self.session.feature('ExposureTime')
+        curtime = exposure_time.get()
+        inc = exposure_time.get_increment()
+
+        if curtime < integrationTime:
+        # Calculate the number of increments needed to reach the target integration time
+            num_increments = int((integrationTime - curtime) / inc) + 1
+            # Increase the exposure time by the calculated number of increments
+            exposure_time.set(curtime + (inc*num_increments))
+            print(exposure_time.get())
+        else:
+        # Calculate the number of decrements needed to reach the target integration time
+            num_decrements = int((curtime - integrationTime) / inc) + 1
+            # Decrease the exposure time by the calculated number of decrements
+            exposure_time.set(curtime - (inc*num_decrements))
+            print(exposure_time.get())
+        '''
+        exposure_time = cam.ExposureTime
+        curtime = exposure_time.get()
+        inc = exposure_time.get_increment()
+        if curtime < integrationTime:
+            while curtime < integrationTime:
+                QCoreApplication.processEvents()
+                #print('new_time: '+str(curtime+inc))
+                exposure_time.set(curtime + inc)
                 curtime = exposure_time.get()
-                inc = exposure_time.get_increment()
-
-                if curtime < integrationTime:
-                # Calculate the number of increments needed to reach the target integration time
-                    num_increments = int((integrationTime - curtime) / inc) + 1
-                    # Increase the exposure time by the calculated number of increments
-                    exposure_time.set(curtime + (inc*num_increments))
-                    print(exposure_time.get())
-                else:
-                # Calculate the number of decrements needed to reach the target integration time
-                    num_decrements = int((curtime - integrationTime) / inc) + 1
-                    # Decrease the exposure time by the calculated number of decrements
-                    exposure_time.set(curtime - (inc*num_decrements))
-                    print(exposure_time.get())
-                '''
-                exposure_time = cam.ExposureTime
+        else:
+            while curtime - inc > integrationTime:
+                QCoreApplication.processEvents()
+                #print('new_time: '+str(curtime-inc))
+                exposure_time.set(curtime - inc)
                 curtime = exposure_time.get()
-                inc = exposure_time.get_increment()
-                if curtime < integrationTime:
-                    while curtime < integrationTime:
-                        QCoreApplication.processEvents()
-                        #print('new_time: '+str(curtime+inc))
-                        exposure_time.set(curtime + inc)
-                        curtime = exposure_time.get()
-                else:
-                    while curtime - inc > integrationTime:
-                        QCoreApplication.processEvents()
-                        #print('new_time: '+str(curtime-inc))
-                        exposure_time.set(curtime - inc)
-                        curtime = exposure_time.get()
-                '''
+        '''
+
+    '''
+    Finds an integration time that puts the given percentile of the (downsampled)
+    frame histogram at target (fraction of full scale) within tolerance, taking
+    one frame per iteration. Unsaturated frames are close to linear in exposure
+    so the next guess comes from a secant through the last two readings (or a
+    straight proportional step for the first); saturated frames carry no level
+    information so those bisect towards the last known underexposed time.
+    Stays inside getIntegrationTimeRange and returns the final time in us.
+    '''
+    def autoExposure(self, target=0.8, percentile=99.5, tolerance=0.05, maxFrames=8, downsample=4) -> float:
+        low, high = self.getIntegrationTimeRange()
+        under, over = low, high
+        previous = None
+        current = self.getIntegrationTime()
+        for n in range(maxFrames):
+            level = self.exposureLevel(percentile, downsample)
+            print(f"Auto exposure: {current:.0f}us -> {level:.3f}")
+            if abs(level - target) <= tolerance:
+                break
+            if level < target:
+                under = max(under, current)
+            else:
+                over = min(over, current)
+            if level >= 0.99:
+                # saturated, geometric bisection towards the underexposed side
+                guess = math.sqrt(under * current)
+            elif previous is not None and previous[1] < 0.99 and previous[1] != level:
+                t0, l0 = previous
+                guess = current + (target - level) * (current - t0) / (level - l0)
+            elif level > 0:
+                guess = current * target / level
+            else:
+                guess = current * 8
+            # keep the guess strictly inside the bracket found so far
+            if not under < guess < over:
+                guess = math.sqrt(under * over)
+            previous = (current, level)
+            self.setIntegrationTime(guess)
+            newTime = self.getIntegrationTime()
+            if newTime == current:
+                # pinned at a limit or the increment, nothing more to gain
+                break
+            current = newTime
+        return current
+
+    '''
+    Takes one frame and returns the given percentile of its pixel values as a
+    fraction of full scale, from a histogram of every downsample-th pixel
+    '''
+    def exposureLevel(self, percentile=99.5, downsample=4) -> float:
+        maxValue = self.maxPixelValue()
+        frame = self.takeFrameNDArray()
+        sample = frame[::downsample, ::downsample].ravel()
+        counts = np.cumsum(np.bincount(sample, minlength=maxValue + 1))
+        value = np.searchsorted(counts, percentile / 100 * counts[-1])
+        return min(value, maxValue) / maxValue
+
+    def maxPixelValue(self) -> int:
+        from vmbpy import PixelFormat
+        format = self.getPixelFormat()
+        if format == PixelFormat.Mono8:
+            return 255
+        if format in (PixelFormat.Mono10, PixelFormat.Mono10p):
+            return 1023
+        return 4095
 
     def getIntegrationTime(self) -> float:
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                return cam.ExposureTime.get()
+        return self.session.feature('ExposureTime').get()
 
     def getIntegrationTimeRange(self) -> float:
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                return cam.ExposureTime.get_range()
+        return self.session.feature('ExposureTime').get_range()
 
     def takeFrame(self) -> Frame:
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                return cam.get_frame()
+        return self.session.camera().get_frame()
 
     def takeFrameNDArray(self) -> Frame:
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                return cam.get_frame().as_numpy_ndarray()
+        return self.frameToNDArray(self.session.camera().get_frame())
+
+    '''
+    Converts a frame to a uint16/uint8 ndarray, decoding packed Mono12p/Mono10p
+    frames (which vmbpy can't turn into an ndarray itself)
+    '''
+    def frameToNDArray(self, frame):
+        unpack = self.unpacker()
+        if unpack is None:
+            return frame.as_numpy_ndarray()
+        arr = np.empty((frame.get_height(), frame.get_width(), 1), np.uint16)
+        unpack(np.frombuffer(frame.get_buffer(), np.uint8), arr)
+        return arr
+
+    # decoder for the current pixel format, None when frames are not packed
+    def unpacker(self):
+        from vmbpy import PixelFormat
+        format = self.getPixelFormat()
+        if format == PixelFormat.Mono12p:
+            return unpackMono12p
+        if format == PixelFormat.Mono10p:
+            return unpackMono10p
+        return None
 
     def takeFrameCV(self) -> Frame:
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                return cam.get_frame().as_opencv_image()
+        return self.session.camera().get_frame().as_opencv_image()
 
-    def scanNDArray(self, d) -> Frame:
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                arr = []
-                total_images = d.getImagesPerScene()
-                for i in range(total_images):
-                    a = []
-                    for j in range(self.imagesPerStep):
-                        QCoreApplication.processEvents()
-                        if self.cancelled:
-                            break
-                        frame = cam.get_frame().as_numpy_ndarray()
-                        a.append(frame)
+    '''
+    Scans the scene with driver d. If out is a .npy or .hdr path the cube is
+    written into that file as it is taken and a memory-mapped cube is returned.
+    '''
+    def scanNDArray(self, d, out=None) -> Frame:
+        if self.continuous:
+            return self.scanContinuous(d, out)
+        if self.streaming:
+            return self.scanStreaming(d, out)
+        return self.scanSynchronous(d, out)
+
+    '''
+    Scan using continuous acquisition: the camera streams into a FramePool at its
+    own rate and this loop only consumes finished buffers. Frames whose exposure
+    started before the last motor move completed are thrown away so every step
+    only averages frames of a stationary scene; exposure times come from the
+    camera timestamps mapped onto the host clock, so late delivery of a frame
+    doesn't change which step it counts for. As soon as the last frame of a
+    step is in, the frames go to a ScanPipeline worker for averaging and the
+    motor is told to move, so the NumPy work overlaps the motion.
+    If the driver is in plan mode the whole scan is sent to the controller up
+    front and each step starts on the controller's arrival report instead of a
+    step() round trip; frames that end after the dwell are not used. The dwell
+    is sized from the measured frame period for the worst frame phase. Frames
+    come on a fixed grid, so as soon as the frame before a step's first is in,
+    the end of the step's last frame is known and the controller is told to
+    leave then (releasePosition); a step costs the move and its own frames
+    without a round trip. Steps that still end up with fewer than imagesPerStep
+    frames are counted in lastScanStats['shortSteps'].
+    '''
+    def scanStreaming(self, d, out=None) -> Frame:
+        cam = self.session.camera()
+        exposure = self.getIntegrationTime() / 1e6
+        # one frame period plus transfer slack before we decide the camera stalled
+        timeout = exposure + 1.0
+        # enough buffers for the worker to hold one step while the next is captured
+        count = max(self.bufferCount, 2 * self.imagesPerStep + 2)
+        shape = self.frameShape()
+        dtype = self.frameDtype()
+        pool = FramePool(shape, dtype, count, self.unpacker())
+        frames = 0
+        total_images = d.getImagesPerScene()
+        pipeline = ScanPipeline(ScanCube(shape, total_images, dtype, out, self.tracksSNR()), pool.release,
+                                self.emitStepReady)
+        start = time.monotonic()
+        settled = start
+        plan = d.planMode
+        shortSteps = 0
+        # camera clock -> host clock, the smallest arrival - end of exposure seen
+        offset = math.inf
+        cam.start_streaming(handler=pool.handler, buffer_count=count)
+        try:
+            if plan:
+                # frames start every frame period, so the first one to start after
+                # the arrival does so within a period, and the last of the step
+                # ends (imagesPerStep - 1) periods and an exposure after that
+                period = max(self.measureFramePeriod(pool, timeout), exposure)
+                dwell = self.imagesPerStep * period + exposure + self.planDwellMargin
+                d.startPlan(dwell)
+
+            # tells the controller to leave plan position index once an exposure
+            # ending at end is over, returns the new deadline for this step
+            def release(index, end):
+                leave = min(end - settled + self.planDwellMargin, dwell)
+                d.releasePosition(index, leave)
+                return settled + leave
+
+            for i in range(total_images):
+                if plan:
+                    pool.collecting = False
+                    index, settled = d.waitForArrival()
+                    pool.collecting = True
+                    deadline = settled + dwell
+                    # nothing to release after the last position
+                    released = i == total_images - 1
+                a = []
+                while len(a) < self.imagesPerStep:
                     if self.cancelled:
-                        self.cancelledChanged.emit(True)
                         break
-                    # Stack the arrays along a new axis
-                    a = np.stack(a)
-                    # Compute the average along the new axis
-                    a = np.mean(a, axis=0)
-                    # below is for SNR verification update on pixels not used
-                    #b = np.stddev(a, axis=0)
-                    #c = np.divide(a, b)
-                    #mi = np.min(c) # this will have to be changed for unused pixels
-
-                    a = np.floor(a)
-                    arr.append(a)
+                    arrival, buf, stamp = pool.get(timeout)
+                    offset = min(offset, arrival - stamp / 1e9 - exposure)
+                    begin = stamp / 1e9 + offset
+                    if begin < settled:
+                        # exposure overlapped the motor move
+                        pool.release(buf)
+                        if plan and not released and begin + period >= settled:
+                            # the next frame is the step's first
+                            deadline = release(index, begin + self.imagesPerStep * period + exposure)
+                            released = True
+                        continue
+                    if plan and not released:
+                        deadline = release(index, begin + (self.imagesPerStep - 1 - len(a)) * period + exposure)
+                        released = True
+                    if plan and begin + exposure > deadline:
+                        # the controller has already moved on
+                        pool.release(buf)
+                        if not a:
+                            raise RuntimeError(f'No frame of scan plan position {index} ended before the '
+                                               'controller moved on')
+                        break
+                    a.append(buf)
+                    frames += 1
+                if self.cancelled:
+                    for buf in a:
+                        pool.release(buf)
+                    if plan:
+                        d.abortPlan()
+                        plan = False
+                    self.cancelledChanged.emit(True)
+                    break
+                if len(a) < self.imagesPerStep:
+                    shortSteps += 1
+                pipeline.submit(i, a)
+                if not plan:
+                    pool.collecting = False
                     d.step(1)
-                    progress = int(((i + 1) / total_images) * 100)
-                    self.progressChanged.emit(progress)
-                arrs = np.concatenate(arr, axis=2)
-                return arrs
+                    settled = time.monotonic()
+                    pool.collecting = True
+                progress = int(((i + 1) / total_images) * 100)
+                self.progressChanged.emit(progress)
+            if plan:
+                d.finishPlan()
+        except BaseException:
+            # a plan left running keeps its reader on the port, where it would
+            # swallow the replies to the next reset() or step()
+            if plan:
+                d.abortPlan()
+            raise
+        finally:
+            cam.stop_streaming()
+            cube = pipeline.finish()
+            self.lastSNR = pipeline.cube.snrResult()
+        self.recordScanStats(frames, time.monotonic() - start, pool.dropped, shortSteps, pool.skipped)
+        return cube
+
+    # median time between frames of the running stream from their camera timestamps
+    def measureFramePeriod(self, pool, timeout, count=4) -> float:
+        stamps = []
+        for i in range(count):
+            arrival, buf, stamp = pool.get(timeout)
+            stamps.append(stamp)
+            pool.release(buf)
+        return float(np.median(np.diff(stamps))) / 1e9
+
+    '''
+    Continuous scan: the mirror sweeps the whole scene at constant velocity
+    while the camera streams. Every frame is tagged with its camera timestamp,
+    mapped onto the host clock, and given the angle the mirror had at mid
+    exposure. Each frame goes to the column of the regular grid a stop and
+    stare scan would use (one column every stepsPerImage steps) nearest that
+    angle, and a column averages the imagesPerStep frames closest to it. The
+    sweep speed aims at imagesPerStep frames per column (more when the motor's
+    top speed caps it). As the angles only ever increase, a column is averaged
+    through a ScanPipeline (with SNR, preview and a memory-mapped out like
+    scanStreaming) as soon as the first frame of the next one is in, so only
+    the frames of about two columns are ever held. Columns no frame landed in
+    are interpolated from their neighbours; they and columns with fewer than
+    imagesPerStep frames are counted in lastScanStats['shortSteps']. Frame
+    angles are kept in lastFrameAngles.
+    '''
+    def scanContinuous(self, d, out=None) -> Frame:
+        cam = self.session.camera()
+        exposure = self.getIntegrationTime() / 1e6
+        timeout = exposure + 1.0
+        shape = self.frameShape()
+        dtype = self.frameDtype()
+        # a column being collected and one being averaged, with room for a spare frame each
+        count = max(self.bufferCount, 2 * self.imagesPerStep + 4)
+        pool = FramePool(shape, dtype, count, self.unpacker())
+        total_images = d.getImagesPerScene()
+        stepsPerImage = d.getStepsPerImage()
+        pipeline = ScanPipeline(ScanCube(shape, total_images, dtype, out, self.tracksSNR()), pool.release,
+                                self.emitStepReady)
+        filled = np.zeros(total_images, bool)
+        shortSteps = 0
+        angles = []
+        n = 0
+        sweeping = False
+        start = time.monotonic()
+        cam.start_streaming(handler=pool.handler, buffer_count=count)
+        try:
+            # measure the real frame period from a few frames before moving
+            period = self.measureFramePeriod(pool, timeout)
+            # the rate the controller really runs, so the capture covers the whole sweep
+            stepRate = d.sweepRateFor(stepsPerImage / (self.imagesPerStep * period))
+            sweepSteps = stepsPerImage * (total_images - 1)
+            duration = sweepSteps / stepRate
+            pool.flush()
+            d.startSweep(sweepSteps, stepRate)
+            sweeping = True
+            index, startTime = d.waitForArrival()
+            startAngle = d.angleAt(startTime, startTime)
+            pitch = stepsPerImage * d.DegreesPerStep
+            # camera clock -> host clock: arrival is end of exposure plus transfer, so
+            # the smallest arrival - (timestamp + exposure) so far is the best estimate
+            offset = math.inf
+            column = 0
+            # (distance from the column's angle, buffer) of the frames kept for it
+            a = []
+
+            def submit():
+                pipeline.submit(column, [buf for distance, buf in a])
+                filled[column] = True
+                return int(len(a) < self.imagesPerStep)
+
+            while True:
+                if self.cancelled:
+                    break
+                arrival, buf, stamp = pool.get(timeout)
+                offset = min(offset, arrival - stamp / 1e9 - exposure)
+                begin = stamp / 1e9 + offset
+                # frames before the start or after the end see the mirror standing there
+                angle = d.angleAt(begin + exposure / 2, startTime)
+                angles.append(angle)
+                n += 1
+                target = min(max(int(math.floor((angle - startAngle) / pitch + 0.5)), 0), total_images - 1)
+                if target != column and a:
+                    shortSteps += submit()
+                    a = []
+                column = target
+                a.append((abs(angle - startAngle - column * pitch), buf))
+                if len(a) > self.imagesPerStep:
+                    farthest = max(range(len(a)), key=lambda k: a[k][0])
+                    pool.release(a.pop(farthest)[1])
+                # stop once a frame started after the sweep ended and the last column is full
+                if begin > startTime + duration and len(a) >= self.imagesPerStep:
+                    break
+                self.progressChanged.emit(min(99, int((arrival - startTime) / duration * 100)))
+            if self.cancelled:
+                for distance, buf in a:
+                    pool.release(buf)
+            elif a:
+                shortSteps += submit()
+        except BaseException:
+            # the sweep's reader would otherwise stay on the port
+            if sweeping:
+                d.abortPlan()
+            raise
+        finally:
+            cam.stop_streaming()
+            cube = pipeline.finish()
+        if self.cancelled:
+            d.abortPlan()
+            self.cancelledChanged.emit(True)
+            return None
+        d.finishPlan()
+        pipeline.cube.fillGaps(filled)
+        cube = pipeline.cube.result()
+        self.lastFrameAngles = np.array(angles)
+        self.lastSNR = pipeline.cube.snrResult()
+        self.recordScanStats(n, time.monotonic() - start, pool.dropped, shortSteps + int(np.sum(~filled)))
+        self.progressChanged.emit(100)
+        return cube
+
+    def scanSynchronous(self, d, out=None) -> Frame:
+        cam = self.session.camera()
+        start = time.monotonic()
+        frames = 0
+        total_images = d.getImagesPerScene()
+        cube = ScanCube(self.frameShape(), total_images, self.frameDtype(), out, self.tracksSNR())
+        for i in range(total_images):
+            a = []
+            for j in range(self.imagesPerStep):
+                if self.cancelled:
+                    break
+                frame = self.frameToNDArray(cam.get_frame())
+                a.append(frame)
+                frames += 1
+            if self.cancelled:
+                self.cancelledChanged.emit(True)
+                break
+            # average straight into the cube, with per pixel SNR if tracked
+            cube.addStep(i, a)
+            self.emitStepReady(i, cube.cube)
+            d.step(1)
+            progress = int(((i + 1) / total_images) * 100)
+            self.progressChanged.emit(progress)
+        self.recordScanStats(frames, time.monotonic() - start, 0)
+        self.lastSNR = cube.snrResult()
+        return cube.result()
+
+    def emitStepReady(self, index, cube) -> None:
+        self.stepReady.emit(index, cube[:, index, :])
+
+    '''
+    dropped counts frames lost while a step was collecting them, skipped the
+    ones lost while the scan waited on the motor, which no step could use
+    '''
+    def recordScanStats(self, frames, seconds, dropped, shortSteps=0, skipped=0) -> None:
+        fps = frames / seconds if seconds > 0 else 0.0
+        self.lastScanStats = {'frames': frames, 'seconds': seconds, 'fps': fps,
+                              'dropped': dropped, 'skipped': skipped, 'shortSteps': shortSteps}
+        print(f"Scan: {frames} frames in {seconds:.2f}s ({fps:.1f} frames/s, {dropped} dropped, "
+              f"{skipped} skipped while moving)")
+        if shortSteps:
+            print(f"Warning: {shortSteps} steps averaged fewer than {self.imagesPerStep} frames")
+
+    def getLastScanStats(self) -> dict:
+        return self.lastScanStats
+
+    '''
+    SNR cube (rows x steps x columns, float32) of the last scan, or None if
+    trackSNR was off or there was only one image per step
+    '''
+    def getLastSNR(self):
+        return self.lastSNR
+
+    def setTrackSNR(self, trackSNR) -> None:
+        self.trackSNR = trackSNR
+
+    # a single frame per step has no spread to measure, so SNR is skipped then
+    def tracksSNR(self) -> bool:
+        return self.trackSNR and self.imagesPerStep >= 2
+
+    def frameShape(self) -> tuple:
+        return (self.session.feature('Height').get(), self.session.feature('Width').get(), 1)
+
+    def frameDtype(self):
+        from vmbpy import PixelFormat
+        if self.getPixelFormat() == PixelFormat.Mono8:
+            return np.uint8
+        return np.uint16
 
     def cancelOperation(self):
         self.cancelled = True
 
     def getPixelFormats(self) -> tuple:
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                return cam.get_pixel_formats()
+        return self.session.camera().get_pixel_formats()
 
 
     def getPixelFormat(self) -> tuple:
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                return cam.get_pixel_format()
+        return self.session.camera().get_pixel_format()
+
+    def hasPixelFormat(self, format) -> bool:
+        return format.lower() in [str(f).lower() for f in self.getPixelFormats()]
+
+    '''
+    Restricts readout to a region of interest, offsets and sizes are in (binned)
+    sensor pixels and a width/height of None means the rest of the sensor after
+    the offset. Sizes are rounded up and offsets down to the camera increments
+    so the requested window is always covered. Scans size their cube from the
+    ROI, so a smaller window means higher frame rates and smaller cubes.
+    '''
+    def setROI(self, offsetX=0, offsetY=0, width=None, height=None) -> None:
+        for offsetName, sizeName, offset, size in (('OffsetX', 'Width', offsetX, width),
+                                                   ('OffsetY', 'Height', offsetY, height)):
+            offsetFeature = self.session.feature(offsetName)
+            sizeFeature = self.session.feature(sizeName)
+            # move to the corner first so any new size fits
+            offsetFeature.set(offsetFeature.get_range()[0])
+            sizeMin, sizeMax = sizeFeature.get_range()
+            if size is None:
+                size = sizeMax - offset
+            size = snapToIncrement(sizeFeature, min(max(size, sizeMin), sizeMax), roundUp=True)
+            sizeFeature.set(size)
+            offset = min(offset, sizeMax - size)
+            offsetFeature.set(snapToIncrement(offsetFeature, offset))
+
+    def resetROI(self) -> None:
+        self.setROI(0, 0, None, None)
+
+    def getROI(self) -> tuple:
+        return tuple(self.session.feature(name).get() for name in ('OffsetX', 'OffsetY', 'Width', 'Height'))
+
+    '''
+    On-chip binning, horizontal bins spectral columns and vertical bins spatial
+    rows. Changing binning changes the sensor size so the ROI is reset to the
+    full binned sensor, set it again afterwards.
+    '''
+    def setBinning(self, horizontal=1, vertical=1) -> None:
+        self.session.feature('BinningHorizontal').set(horizontal)
+        self.session.feature('BinningVertical').set(vertical)
+        self.resetROI()
+
+    def getBinning(self) -> tuple:
+        return (self.session.feature('BinningHorizontal').get(),
+                self.session.feature('BinningVertical').get())
 
     def setPixelFormat(self, format) -> None:
+        from vmbpy import PixelFormat
         format1 = format.lower()
-        with VmbSystem.get_instance() as vmb:
-            cams = vmb.get_all_cameras()
-            with cams[0] as cam:
-                if format1 == "mono8":
-                    cam.set_pixel_format(PixelFormat.Mono8)
-                elif format1 == "mono10":
-                    cam.set_pixel_format(PixelFormat.Mono10)
-                elif format1 == "mono10p":
-                    cam.set_pixel_format(PixelFormat.Mono10p)
-                elif format1 == "mono12":
-                    cam.set_pixel_format(PixelFormat.Mono12)
-                elif format1 == "mono12p":
-                    cam.set_pixel_format(PixelFormat.Mono12p)
-                else:
-                    print("Unknown format: " + format1)
+        cam = self.session.camera()
+        if format1 == "mono8":
+            cam.set_pixel_format(PixelFormat.Mono8)
+        elif format1 == "mono10":
+            cam.set_pixel_format(PixelFormat.Mono10)
+        elif format1 == "mono10p":
+            cam.set_pixel_format(PixelFormat.Mono10p)
+        elif format1 == "mono12":
+            cam.set_pixel_format(PixelFormat.Mono12)
+        elif format1 == "mono12p":
+            cam.set_pixel_format(PixelFormat.Mono12p)
+        else:
+            print("Unknown format: " + format1)
     def getImagesPerStep(self) -> int:
         return self.imagesPerStep
 
     def setImagesPerStep(self, imagesPerStep) -> None:
         self.imagesPerStep = imagesPerStep
+
+class ScanWorker(QObject):
+    '''
+    Runs a scan off the GUI thread: move it to a QThread and connect the thread's
+    started signal to run(). The cube comes back through finished, errors through
+    failed; progress, steps and cancellation go through the camera's signals.
+    Cancel with camera.cancelOperation() from any thread. The motor is homed
+    here too, before the scan with resetFirst and after a cancelled one, so the
+    GUI thread never waits on the serial port and a motor timeout comes back
+    through failed like any other error.
+    '''
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, camera, driver, out=None, autoExposure=False, resetFirst=False) -> None:
+        super().__init__()
+        self.camera = camera
+        self.driver = driver
+        self.out = out
+        self.autoExposure = autoExposure
+        self.resetFirst = resetFirst
+
+    @pyqtSlot()
+    def run(self) -> None:
+        try:
+            if self.resetFirst:
+                self.driver.reset()
+            if self.autoExposure:
+                self.camera.autoExposure()
+            cube = self.camera.scanNDArray(self.driver, self.out)
+            if self.camera.cancelled:
+                # back to the start position for the next scan
+                self.driver.reset()
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.finished.emit(cube)
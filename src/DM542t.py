@@ -1,16 +1,86 @@
+import os
+import queue
+import threading
 import serial
 import time
 import math
 import struct
 
+# 'hardware' for the Arduino, 'sim' for simulation.SimulatedSerial
+_backend = os.environ.get('SPECTROMETER_BACKEND', 'hardware')
+# USB vendor ids of Arduino boards and the usual USB-serial chips on clones
+ARDUINO_VIDS = (0x2341, 0x2A03, 0x1A86, 0x0403, 0x10C4)
+# one serial connection shared by every driver object, the port can only be opened once
+_connection = None
+
+def setBackend(backend) -> None:
+    global _backend
+    if backend not in ('hardware', 'sim'):
+        raise ValueError('Unknown motor backend: ' + backend)
+    if backend != _backend:
+        closeConnection()
+        _backend = backend
+
+def getConnection():
+    global _connection
+    if _connection is None:
+        if _backend == 'sim':
+            import simulation
+            _connection = simulation.SimulatedSerial(stepDelay=DM542t.MotorDelay)
+        else:
+            # Establish a serial connection with the Arduino
+            _connection = serial.Serial(findPort(), 115200)
+    return _connection
+
+'''
+Picks the Arduino's serial port: SPECTROMETER_PORT if set, otherwise the first
+port that looks like an Arduino by USB vendor id or description, otherwise COM3
+'''
+def findPort() -> str:
+    if os.environ.get('SPECTROMETER_PORT'):
+        return os.environ['SPECTROMETER_PORT']
+    from serial.tools import list_ports
+    for port in list_ports.comports():
+        if port.vid in ARDUINO_VIDS or 'arduino' in (port.description or '').lower():
+            return port.device
+    return 'COM3'
+
+def closeConnection() -> None:
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+
+class MotorTimeoutError(Exception):
+    pass
+
 class DM542t:
-    # Establish a serial connection with the Arduino
-    arduino = serial.Serial('COM3', 115200)  # replace 'COM3' with the port where your Arduino is connected
     MotorDelay = .0018
+    # .0004 is the movement of one step
+    DegreesPerStep = .0004
+    # slack on top of the expected move time before a missing ack is an error
+    AckMargin = 1.0
+    # special signed short values that start a multi byte command instead of a move
+    PlanCommand = -32768
+    AbortCommand = -32767
+    SweepCommand = -32766
+    ReleaseCommand = -32765
+    # the plan dwell goes out as whole ms in an unsigned short
+    MaxDwell = 65.535
     def __init__(self) -> None:
         self.stepsTaken = 0
         self.stepsPerImage = 21
         self.imagesPerScene = 63
+        # scan plan mode: the whole scan goes to the controller in one command
+        self.planMode = False
+        self.startSteps = 0
+        self.arrivals = None
+        self.planReader = None
+
+    # the serial port is opened the first time the motor is actually used
+    @property
+    def arduino(self):
+        return getConnection()
 
     def step(self, steps) -> None:
         if steps != 0:
@@ -20,14 +90,8 @@ class DM542t:
             # Write packed number to serial port
             self.arduino.write(packed_num)
             # self.arduino.write(str(steps*self.stepsPerImage).encode())
-            # Wait for any data to arrive
-            while True:
-                if self.arduino.inWaiting() > 0:
-                    data = self.arduino.read(self.arduino.inWaiting()).decode('utf-8')
-                    print("Data received: ", data)
-                    break
-                # print("Waiting")
-            # time.sleep(abs(steps*self.stepsPerImage*self.MotorDelay))
+            # Wait for the Arduino to report the move is done
+            self.waitForAck(steps*self.stepsPerImage)
 
 
     def reset(self) -> None:
@@ -36,19 +100,29 @@ class DM542t:
         # Write packed number to serial port
         self.arduino.write(packed_num)
         # self.arduino.write(str(0).encode())
-        # Wait for any data to arrive
-        while True:
-            if self.arduino.inWaiting() > 0:
-                data = self.arduino.read(self.arduino.inWaiting()).decode('utf-8')
-                print("Data received: ", data)
-                break
-            # print("Waiting")
-        # if self.stepsTaken == 0:
-        #     time.sleep(abs(self.stepsPerImage*self.imagesPerScene*self.MotorDelay))
-        # else:
-        #     time.sleep(abs(self.stepsTaken*self.MotorDelay))
+        # the way home is at most the steps we took, or a whole scene if we don't know
+        if self.stepsTaken == 0:
+            self.waitForAck(self.stepsPerImage*self.imagesPerScene)
+        else:
+            self.waitForAck(self.stepsTaken)
         self.stepsTaken = 0
 
+    '''
+    Blocks (without spinning) until the Arduino acknowledges a move of the given
+    number of steps with a full line, so no part of the reply is left behind to
+    be taken for the next move's ack. The wait is bounded by the time the move
+    should take plus AckMargin, after which MotorTimeoutError is raised.
+    '''
+    def waitForAck(self, steps) -> str:
+        timeout = abs(steps)*self.MotorDelay + self.AckMargin
+        self.arduino.timeout = timeout
+        data = self.arduino.readline()
+        if not data.endswith(b'\n'):
+            raise MotorTimeoutError(f"No acknowledgment from the motor controller after {timeout:.2f}s")
+        data = data.decode('utf-8')
+        print("Data received: ", data)
+        return data
+
     def getStepsPerScene(self) -> int:
         return self.stepsPerImage * self.imagesPerScene
 
@@ -69,9 +143,133 @@ class DM542t:
 
     def setStart(self, startDegree) -> None:
         # .0004 is the movement of one step
-        steps = math.floor(startDegree/.0004)
+        steps = math.floor(startDegree/self.DegreesPerStep)
+        if self.planMode:
+            # sent as part of the plan instead of as its own move
+            self.startSteps = steps
+            return
         temp = self.stepsPerImage
         self.stepsPerImage = 1
         self.step(steps)
         self.stepsPerImage = temp
 
+    '''
+    Scan plan protocol, one command for the whole scan instead of a round trip per
+    step. Sends PlanCommand followed by start offset, steps per image, images
+    per scene and dwell in ms. The controller moves to the start, then for every
+    image sends "A<index>" once it has arrived, waits dwell (or less, see
+    releasePosition) and moves on (no move after the last image) and finishes
+    with "D". Needs the matching firmware. Raises ValueError for a dwell the
+    command can't carry, over MaxDwell.
+    '''
+    def startPlan(self, dwell) -> None:
+        images = self.imagesPerScene
+        # rounded up, a dwell cut short would end steps early
+        dwellMs = math.ceil(dwell*1000)
+        if not 0 <= dwellMs <= 65535:
+            raise ValueError(f'Scan plan dwell of {dwell:.3f}s is outside 0 to {self.MaxDwell}s, '
+                             'use fewer images per step or a shorter integration time')
+        self.arduino.reset_input_buffer()
+        self.arrivals = queue.Queue()
+        self.arduino.write(struct.pack('h', self.PlanCommand) +
+                           struct.pack('hhHH', self.startSteps, self.stepsPerImage, images, dwellMs))
+        self.stepsTaken += self.startSteps + self.stepsPerImage*(images - 1)
+        # a line is due at least every dwell plus the longest move
+        timeout = self.AckMargin + dwell + max(abs(self.startSteps), abs(self.stepsPerImage))*self.MotorDelay
+        self.startSteps = 0
+        self.planReader = threading.Thread(target=self.readPlan, args=(timeout,), daemon=True)
+        self.planReader.start()
+
+    '''
+    Shortens the dwell at plan position index to leave seconds after the
+    controller arrived there (counted on its own clock, so the serial latency
+    doesn't matter as long as the command gets there first; if it is late the
+    controller leaves when it comes). ReleaseCommand followed by index and
+    leave in ms. The dwell stays the upper bound, and a release for a position
+    the controller already left is ignored.
+    '''
+    def releasePosition(self, index, leave) -> None:
+        leaveMs = min(max(math.ceil(leave*1000), 0), 65535)
+        self.arduino.write(struct.pack('h', self.ReleaseCommand) + struct.pack('hH', index, leaveMs))
+
+    # reader thread, turns controller lines into (index, arrival time) on the arrivals queue
+    def readPlan(self, timeout) -> None:
+        self.arduino.timeout = timeout
+        while True:
+            line = self.arduino.readline()
+            now = time.monotonic()
+            if not line:
+                self.arrivals.put((None, MotorTimeoutError('Motor controller stopped reporting during the scan plan')))
+                return
+            line = line.decode('utf-8').strip()
+            if line.startswith('A'):
+                self.arrivals.put((int(line[1:]), now))
+            elif line.startswith('D'):
+                self.arrivals.put((None, None))
+                return
+
+    '''
+    The step rate the controller will actually run for a requested one: the
+    command carries whole steps/s, at least 1 and no faster than MotorDelay
+    allows. Callers timing a sweep should use this rather than what they asked for.
+    '''
+    def sweepRateFor(self, stepRate) -> int:
+        return int(min(max(round(stepRate), 1), 1/self.MotorDelay))
+
+    '''
+    Continuous motion: SweepCommand followed by a step count and a step rate in
+    whole steps/s (see sweepRateFor). The controller moves at that constant
+    rate, reports "A0" when the first step goes out and "D" after the last one.
+    waitForArrival() returns the start time, from which angleAt() gives the
+    mirror angle at any time.
+    '''
+    def startSweep(self, steps, stepRate) -> None:
+        stepRate = self.sweepRateFor(stepRate)
+        self.arduino.reset_input_buffer()
+        self.arrivals = queue.Queue()
+        self.arduino.write(struct.pack('h', self.SweepCommand) + struct.pack('hH', steps, stepRate))
+        self.sweepStartSteps = self.stepsTaken
+        self.sweepSteps = steps
+        self.sweepRate = stepRate
+        self.stepsTaken += steps
+        timeout = self.AckMargin + abs(steps)/self.sweepRate
+        self.planReader = threading.Thread(target=self.readPlan, args=(timeout,), daemon=True)
+        self.planReader.start()
+
+    # mirror angle in degrees from home at time t of a sweep that started at startTime
+    def angleAt(self, t, startTime) -> float:
+        moved = min(max((t - startTime)*self.sweepRate, 0), abs(self.sweepSteps))
+        return (self.sweepStartSteps + math.copysign(moved, self.sweepSteps))*self.DegreesPerStep
+
+    '''
+    Blocks until the controller reports the next position, returns
+    (image index, time.monotonic() of arrival) or None once the plan is done
+    '''
+    def waitForArrival(self, timeout=None):
+        try:
+            index, value = self.arrivals.get(timeout=timeout)
+        except queue.Empty:
+            raise MotorTimeoutError('No position report from the motor controller')
+        if index is None:
+            if isinstance(value, Exception):
+                raise value
+            return None
+        return (index, value)
+
+    # waits for the controller to finish the plan
+    def finishPlan(self, timeout=None) -> None:
+        while self.planReader is not None and self.planReader.is_alive():
+            if self.waitForArrival(timeout) is None:
+                break
+        self.planReader = None
+
+    # stops the plan early, stepsTaken is only approximate after this
+    def abortPlan(self) -> None:
+        if self.planReader is None:
+            return
+        # a reader that already stopped means the controller is done, an abort
+        # would only get a stray "D" back
+        if self.planReader.is_alive():
+            self.arduino.write(struct.pack('h', self.AbortCommand))
+            self.planReader.join(self.arduino.timeout)
+        self.planReader = None
@@ -0,0 +1,326 @@
+'''
+Helpers for getting frames off the camera and into the scan cube
+'''
+
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# per pixel in a packed group: (low byte, low shift, high byte, high mask, high shift)
+# pixel = (group[low] >> low shift) | ((group[high] & high mask) << high shift)
+MONO12P_LAYOUT = ((0, 0, 1, 0x0F, 8), (1, 4, 2, 0xFF, 4))
+MONO10P_LAYOUT = ((0, 0, 1, 0x03, 8), (1, 2, 2, 0x0F, 6), (2, 4, 3, 0x3F, 4), (3, 6, 4, 0xFF, 2))
+
+'''
+Decodes GenICam LSB packed pixels from the uint8 array raw into the uint16
+array out, writing straight into out's memory. out must be C contiguous and
+can hold one frame or a whole batch of frames back to back.
+'''
+def unpackPacked(raw, out, groupBytes, layout) -> None:
+    if not out.flags.c_contiguous:
+        raise ValueError('unpack output must be C contiguous')
+    pixels = out.reshape(-1, len(layout))
+    groups = raw[:pixels.shape[0] * groupBytes].reshape(-1, groupBytes)
+    for k, (low, lowShift, high, highMask, highShift) in enumerate(layout):
+        p = pixels[:, k]
+        np.copyto(p, groups[:, high])
+        np.bitwise_and(p, highMask, out=p)
+        np.left_shift(p, highShift, out=p)
+        np.bitwise_or(p, groups[:, low] >> lowShift, out=p)
+
+def unpackMono12p(raw, out) -> None:
+    unpackPacked(raw, out, 3, MONO12P_LAYOUT)
+
+def unpackMono10p(raw, out) -> None:
+    unpackPacked(raw, out, 5, MONO10P_LAYOUT)
+
+class FramePool:
+    '''
+    Fixed set of pre-allocated frame buffers recycled through two queues.
+    The streaming callback copies each completed camera frame into a free
+    buffer and hands it to the ready queue; the scan loop takes ready buffers,
+    uses them and gives them back with release(). Nothing is allocated while
+    frames are flowing, and if the consumer falls behind the oldest waiting
+    frame is dropped (and counted) to make room instead of queueing up without
+    bound. Keeping the newest matters after a motor move: the frames that
+    piled up during it are useless, the ones right after it are the step's.
+    Frames lost while collecting is off (the scan loop is waiting on the
+    motor) are counted in skipped rather than dropped, as they couldn't have
+    been used anyway.
+    For packed pixel formats pass unpack (unpackMono12p / unpackMono10p) and
+    the raw frame bytes are decoded straight into the pool buffer.
+    '''
+    def __init__(self, shape, dtype, count, unpack=None) -> None:
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self.unpack = unpack
+        from vmbpy import FrameStatus
+        self.complete = FrameStatus.Complete
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for i in range(count):
+            self.free.put(np.empty(self.shape, self.dtype))
+        self.received = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.collecting = True
+
+    # vmbpy streaming handler, runs on the camera's callback thread
+    def handler(self, cam, stream, frame) -> None:
+        try:
+            if frame.get_status() == self.complete:
+                self.received += 1
+                try:
+                    buf = self.free.get_nowait()
+                except queue.Empty:
+                    if self.collecting:
+                        self.dropped += 1
+                    else:
+                        self.skipped += 1
+                    try:
+                        arrival, buf, stamp = self.ready.get_nowait()
+                    except queue.Empty:
+                        # every buffer is held by the consumer
+                        buf = None
+                if buf is not None:
+                    if self.unpack is not None:
+                        self.unpack(np.frombuffer(frame.get_buffer(), np.uint8), buf)
+                    else:
+                        np.copyto(buf, frame.as_numpy_ndarray())
+                    self.ready.put((time.monotonic(), buf, frame.get_timestamp()))
+        finally:
+            cam.queue_frame(frame)
+
+    '''
+    Returns (arrival time, buffer, camera timestamp) for the next ready frame, the
+    arrival time is time.monotonic() when the frame finished transferring and
+    the timestamp is the camera's own clock in ns
+    '''
+    def get(self, timeout=None):
+        try:
+            return self.ready.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('No frame arrived within ' + str(timeout) + ' s')
+
+    def release(self, buf) -> None:
+        self.free.put(buf)
+
+    # hands every frame still waiting in the ready queue back to the free list
+    def flush(self) -> None:
+        while True:
+            try:
+                arrival, buf, stamp = self.ready.get_nowait()
+            except queue.Empty:
+                return
+            self.free.put(buf)
+
+class StepStatistics:
+    '''
+    Welford running mean/variance over the frames of one step, kept per pixel
+    in float32. Frames are folded in one at a time into fixed buffers, so the
+    cost and memory are the same whatever imagesPerStep is.
+    '''
+    def __init__(self, shape) -> None:
+        self.mean = np.zeros(shape, np.float32)
+        self.m2 = np.zeros(shape, np.float32)
+        self.delta = np.empty(shape, np.float32)
+        self.scratch = np.empty(shape, np.float32)
+        self.count = 0
+
+    def reset(self) -> None:
+        self.mean.fill(0)
+        self.m2.fill(0)
+        self.count = 0
+
+    def add(self, frame) -> None:
+        self.count += 1
+        np.subtract(frame, self.mean, out=self.delta, dtype=np.float32)
+        np.multiply(self.delta, 1.0 / self.count, out=self.scratch)
+        np.add(self.mean, self.scratch, out=self.mean)
+        np.subtract(frame, self.mean, out=self.scratch, dtype=np.float32)
+        np.multiply(self.delta, self.scratch, out=self.scratch)
+        np.add(self.m2, self.scratch, out=self.m2)
+
+    # sample variance, nan when fewer than two frames were seen
+    def variance(self, out=None):
+        if out is None:
+            out = np.empty_like(self.m2)
+        if self.count < 2:
+            out.fill(np.nan)
+        else:
+            np.divide(self.m2, self.count - 1, out=out)
+        return out
+
+    '''
+    Per pixel mean / standard deviation, inf where the pixel never changed and
+    nan when fewer than two frames were seen
+    '''
+    def snr(self, out=None):
+        if out is None:
+            out = np.empty_like(self.mean)
+        std = self.variance(self.delta)
+        np.sqrt(std, out=std)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self.mean, std, out=out)
+        return out
+
+class ScanCube:
+    '''
+    The hyperspectral cube of a scan, allocated once up front as
+    rows x steps x columns in the camera's own integer dtype (12 bit data fits
+    in uint16). Each step's frames are summed into a reusable uint32
+    accumulator and floor divided straight into the step's slice of the cube,
+    so no per-step float64 stacks or final concatenate are needed.
+    If a path is given the cube lives in a memory-mapped .npy (or ENVI .hdr)
+    file instead of RAM, so steps land on disk as they are taken and a
+    cancelled or crashed scan still leaves its finished steps behind.
+    With trackSNR a float32 rows x steps x columns SNR cube is filled in
+    alongside, from a StepStatistics pass over the same frames. It is
+    memory-mapped too when there is a path, as <path>_snr.npy.
+    '''
+    def __init__(self, frameShape, steps, dtype, path=None, trackSNR=False) -> None:
+        rows, columns = frameShape[0], frameShape[1]
+        shape = (rows, steps, columns)
+        self.path = path
+        if path is None:
+            self.cube = np.zeros(shape, dtype)
+        else:
+            self.cube = createCubeFile(path, shape, dtype)
+        self.accumulator = np.empty((rows, columns), np.uint32)
+        self.completed = 0
+        self.stats = None
+        self.snr = None
+        if trackSNR:
+            self.stats = StepStatistics((rows, columns))
+            if path is None:
+                self.snr = np.full(shape, np.nan, np.float32)
+            else:
+                self.snr = np.lib.format.open_memmap(snrPath(path), mode='w+', dtype=np.float32, shape=shape)
+
+    def addStep(self, index, frames) -> None:
+        acc = self.accumulator
+        np.copyto(acc, frames[0][:, :, 0], casting='unsafe')
+        for frame in frames[1:]:
+            np.add(acc, frame[:, :, 0], out=acc, casting='unsafe')
+        # integer floor of the mean, same result as np.floor(np.mean(...))
+        np.floor_divide(acc, len(frames), out=self.cube[:, index, :], casting='unsafe')
+        if self.stats is not None:
+            self.stats.reset()
+            for frame in frames:
+                self.stats.add(frame[:, :, 0])
+            self.stats.snr(self.snr[:, index, :])
+        self.completed = max(self.completed, index + 1)
+
+    # the cube trimmed to the steps actually taken, a view so nothing is copied
+    def result(self):
+        if self.path is not None:
+            self.cube.flush()
+        return self.cube[:, :self.completed, :]
+
+    '''
+    Fills the steps that got no frames (filled[index] False) by linear
+    interpolation between the nearest filled steps on either side, or a copy
+    of the nearest one at the ends, and marks every step as taken
+    '''
+    def fillGaps(self, filled) -> None:
+        have = np.flatnonzero(filled)
+        steps = self.cube.shape[1]
+        if len(have) == 0:
+            return
+        column = np.empty((self.cube.shape[0], self.cube.shape[2]), np.float32)
+        for j in np.flatnonzero(~np.asarray(filled, bool)):
+            upper = int(np.searchsorted(have, j))
+            if upper == 0 or upper == len(have):
+                np.copyto(self.cube[:, j, :], self.cube[:, have[min(upper, len(have) - 1)], :])
+                continue
+            j0, j1 = have[upper - 1], have[upper]
+            w = (j - j0) / (j1 - j0)
+            np.multiply(self.cube[:, j0, :], 1.0 - w, out=column)
+            column += w * self.cube[:, j1, :]
+            np.rint(column, out=column)
+            np.copyto(self.cube[:, j, :], column, casting='unsafe')
+        self.completed = steps
+
+    def snrResult(self):
+        if self.snr is None:
+            return None
+        if self.path is not None:
+            self.snr.flush()
+        return self.snr[:, :self.completed, :]
+
+# where ScanCube keeps the SNR cube of a cube streamed to path
+def snrPath(path) -> str:
+    return os.path.splitext(path)[0] + '_snr.npy'
+
+'''
+Creates a writable memory-mapped cube file, a .npy file by default or an ENVI
+image (band interleaved by pixel, so rows x steps x columns) for a .hdr path
+'''
+def createCubeFile(path, shape, dtype):
+    if path.lower().endswith('.hdr'):
+        from spectral import envi
+        img = envi.create_image(path, shape=shape, dtype=dtype, interleave='bip', force=True)
+        return img.open_memmap(writable=True)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+'''
+Opens a cube written by a scan without reading it into memory
+'''
+def openCubeFile(path):
+    if path.lower().endswith('.hdr'):
+        from spectral import envi
+        return envi.open(path).open_memmap()
+    return np.load(path, mmap_mode='r')
+
+class ScanPipeline:
+    '''
+    Runs the per-step averaging and cube assembly on a worker thread, so the scan
+    loop can start the next motor move as soon as the last frame of a step is in
+    instead of after the NumPy work. Frame buffers are handed back through
+    release once they have been averaged, and onStep(index, cube array) is
+    called (on the worker) once a step is in the cube.
+    '''
+    def __init__(self, cube, release=None, onStep=None) -> None:
+        self.cube = cube
+        self.release = release
+        self.onStep = onStep
+        self.jobs = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, index, frames) -> None:
+        self.jobs.put((index, frames))
+
+    def run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            index, frames = job
+            try:
+                if self.error is None:
+                    self.cube.addStep(index, frames)
+                    if self.onStep is not None:
+                        self.onStep(index, self.cube.cube)
+            except Exception as e:
+                self.error = e
+            finally:
+                if self.release is not None:
+                    for buf in frames:
+                        self.release(buf)
+
+    '''
+    Waits for every submitted step to be assembled and returns the cube,
+    re-raising anything that went wrong on the worker
+    '''
+    def finish(self):
+        self.jobs.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.cube.result()
+
@@ -0,0 +1,117 @@
+'''
+Times a full scan on the simulated camera and stepper, no hardware needed
+    python benchmark.py --images 63 --per-step 1 --exposure 5000 --fps 100
+    python benchmark.py --calibration --images 63
+    python benchmark.py --clustering --clusters 20 --reference
+'''
+
+import argparse
+import time
+import numpy as np
+import Camera
+import DM542t as Driver
+
+def scanBenchmark(args):
+    Camera.setBackend('sim')
+    Driver.setBackend('sim')
+    session = Camera.getSession()
+    session.cameraOptions = {'frameRate': args.fps}
+    cam = Camera.Camera()
+    cam.streaming = not args.sync
+    cam.setImagesPerStep(args.per_step)
+    cam.setIntegrationTime(args.exposure)
+    cam.setPixelFormat(args.format)
+    if args.width:
+        cam.setROI(0, 0, args.width, None)
+    driver = Driver.DM542t()
+    driver.setImagesPerScene(args.images)
+    driver.planMode = args.plan
+    cam.continuous = args.continuous
+    start = time.monotonic()
+    cube = cam.scanNDArray(driver, out=args.out)
+    seconds = time.monotonic() - start
+    stats = cam.getLastScanStats()
+    mode = 'synchronous' if args.sync else 'streaming'
+    if args.plan:
+        mode += ' (scan plan)'
+    if args.continuous:
+        mode = 'continuous'
+    print(f"{mode}: cube {cube.shape} {cube.dtype} in {seconds:.2f}s, "
+          f"{stats['fps']:.1f} frames/s, {stats['dropped']} dropped, {stats['skipped']} skipped while moving, "
+          f"{stats['shortSteps']} short steps")
+    Camera.closeSession()
+    Driver.closeConnection()
+
+'''
+Times the radiometric correction on a random cube the size of a scan, the
+plain numpy expression against the chunked in-place version
+'''
+def calibrationBenchmark(args):
+    import processing
+    rows, columns = 544, args.width or 728
+    rng = np.random.default_rng(0)
+    cube = rng.integers(0, 4096, (rows, args.images, columns), dtype=np.uint16)
+    dark = rng.integers(0, 64, (rows, 1, columns), dtype=np.uint16)
+    gain = rng.random((rows, columns), dtype=np.float32)
+    scale = processing.radianceScale()
+
+    start = time.monotonic()
+    expected = (cube.astype(np.float64) - dark) * gain[:, np.newaxis, :] * scale
+    naive = time.monotonic() - start
+    start = time.monotonic()
+    result = processing.radiometricCorrect(cube, dark, gain, scale, out=args.out)
+    fused = time.monotonic() - start
+    error = np.max(np.abs(result - expected) / np.maximum(np.abs(expected), 1))
+    print(f"radiometric: cube {cube.shape} naive {naive:.3f}s, fused {fused:.3f}s "
+          f"({naive / fused:.1f}x), max relative error {error:.1e}")
+
+'''
+Times clustering a synthetic scene (clusters of noisy spectra) with
+spectral.kmeans and with clustering.kmeans
+'''
+def clusteringBenchmark(args):
+    import clustering
+    rows, columns = 544, args.width or 728
+    rng = np.random.default_rng(0)
+    spectra = rng.uniform(200, 3500, (args.clusters, columns)).astype(np.float32)
+    truth = rng.integers(0, args.clusters, (rows, args.images))
+    cube = (spectra[truth] + rng.normal(0, 50, (rows, args.images, columns))).astype(np.float32)
+
+    # share of pixels whose class is the majority truth class of that class
+    def purity(m):
+        return sum(np.bincount(truth[m == k]).max() for k in np.unique(m)) / truth.size
+
+    start = time.monotonic()
+    m, c = clustering.kmeans(cube, args.clusters, 30)
+    fast = time.monotonic() - start
+    print(f"clustering.kmeans: {fast:.2f}s, {len(np.unique(m))} classes, purity {purity(m):.3f}")
+    if args.reference:
+        import spectral
+        start = time.monotonic()
+        ref, refCenters = spectral.kmeans(cube, args.clusters, 30)
+        slow = time.monotonic() - start
+        print(f"spectral.kmeans: {slow:.2f}s ({slow / fast:.1f}x slower), purity {purity(ref):.3f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated scan throughput benchmark')
+    parser.add_argument('--images', type=int, default=63, help='images per scene')
+    parser.add_argument('--per-step', type=int, default=1, help='frames averaged per step')
+    parser.add_argument('--exposure', type=float, default=5000, help='integration time in us')
+    parser.add_argument('--fps', type=float, default=100, help='simulated sensor frame rate')
+    parser.add_argument('--format', default='mono12', help='pixel format')
+    parser.add_argument('--width', type=int, default=0, help='ROI width, 0 for the full sensor')
+    parser.add_argument('--out', default=None, help='stream the cube to this .npy file')
+    parser.add_argument('--sync', action='store_true', help='use get_frame() per image instead of streaming')
+    parser.add_argument('--plan', action='store_true', help='send the scan to the motor controller as one plan')
+    parser.add_argument('--continuous', action='store_true', help='sweep at constant velocity instead of stop and stare')
+    parser.add_argument('--calibration', action='store_true', help='time the radiometric correction instead of a scan')
+    parser.add_argument('--clustering', action='store_true', help='time k-means on a synthetic scene instead of a scan')
+    parser.add_argument('--clusters', type=int, default=20, help='classes for --clustering')
+    parser.add_argument('--reference', action='store_true', help='also time spectral.kmeans with --clustering (slow)')
+    args = parser.parse_args()
+    if args.calibration:
+        calibrationBenchmark(args)
+    elif args.clustering:
+        clusteringBenchmark(args)
+    else:
+        scanBenchmark(args)
@@ -0,0 +1,209 @@
+'''
+Calibration tables (darks, radiometric gains, the spectral operator) shared by
+every scene processed in a session
+'''
+
+import os
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# tables indexed by integration time and pixel format are saved as
+# <kind>_<pixel format>_<integration time>us.npy, e.g. darks_mono12_5000us.npy
+TABLE_NAME = re.compile(r'^(darks|radioCal)_([a-z0-9]+)_([0-9.]+)us\.npy$')
+# the single tables the lab calibration wrote before, used when nothing is indexed
+LEGACY_FILES = {'darks': 'initialDarks.npy', 'radioCal': 'radioCal.npy'}
+# packed formats unpack to the same values as the plain ones
+PACKED_FORMATS = {'mono12p': 'mono12', 'mono10p': 'mono10'}
+
+def formatKey(pixelFormat) -> str:
+    if pixelFormat is None:
+        return None
+    key = str(pixelFormat).lower().replace('pixelformat.', '')
+    return PACKED_FORMATS.get(key, key)
+
+# integration time as written in table names, fixed point to the ns so that
+# TABLE_NAME matches it at any exposure (no exponent from long ones)
+def timeKey(integrationTime) -> str:
+    return f'{float(integrationTime):.3f}'.rstrip('0').rstrip('.')
+
+def tableName(kind, integrationTime, pixelFormat) -> str:
+    return f'{kind}_{formatKey(pixelFormat)}_{timeKey(integrationTime)}us.npy'
+
+class CalibrationStore:
+    '''
+    Finds the calibration tables in a directory and hands them out by integration
+    time and pixel format. A table is read into RAM in full the first time it is
+    used (through a memmap, so without an intermediate copy) and kept in a least
+    recently used cache up to budget bytes, so back to back scenes don't go back
+    to disk. An integration time between two saved ones gets a linear
+    interpolation of the two (darks grow close to linearly with exposure), which
+    is cached the same way; outside the saved range the nearest table is used.
+    '''
+    def __init__(self, directory='.', budget=512 * 2 ** 20) -> None:
+        self.directory = directory
+        self.budget = budget
+        self.cache = OrderedDict()
+        self.cachedBytes = 0
+        self.lock = threading.Lock()
+        self.index = None
+
+    # {(kind, pixel format): [(integration time, path), ...] sorted by time}
+    def scan(self) -> dict:
+        index = {}
+        for name in os.listdir(self.directory):
+            match = TABLE_NAME.match(name)
+            if match:
+                kind, pixelFormat, integrationTime = match.groups()
+                index.setdefault((kind, pixelFormat), []).append(
+                    (float(integrationTime), os.path.join(self.directory, name)))
+        for entries in index.values():
+            entries.sort()
+        self.index = index
+        return index
+
+    def entries(self, kind, pixelFormat) -> list:
+        if self.index is None:
+            self.scan()
+        return self.index.get((kind, formatKey(pixelFormat)), [])
+
+    '''
+    Least recently used lookup, make() builds the array on a miss. Arrays bigger
+    than the whole budget are returned without being kept.
+    '''
+    def cached(self, key, make):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        value = make()
+        size = tableBytes(value)
+        with self.lock:
+            if size <= self.budget and key not in self.cache:
+                self.cache[key] = value
+                self.cachedBytes += size
+                while self.cachedBytes > self.budget:
+                    old, oldValue = self.cache.popitem(last=False)
+                    self.cachedBytes -= tableBytes(oldValue)
+        return value
+
+    # reads a table into memory through a memmap, so only one copy is made
+    def load(self, path):
+        return self.cached(path, lambda: np.array(np.load(path, mmap_mode='r')))
+
+    '''
+    The table of kind ('darks' or 'radioCal') for the integration time (us) and
+    pixel format, interpolated between the two nearest saved times when
+    interpolate is set, else the nearest one. Without an integration time (or
+    indexed tables for the format) only the legacy single table is used, and
+    FileNotFoundError is raised if there is none.
+    '''
+    def table(self, kind, integrationTime=None, pixelFormat=None, interpolate=True):
+        entries = self.entries(kind, pixelFormat)
+        if integrationTime is not None:
+            # at the resolution of the file names, so a saved time finds its own table
+            integrationTime = float(timeKey(integrationTime))
+        if not entries or integrationTime is None:
+            legacy = os.path.join(self.directory, LEGACY_FILES[kind])
+            if not os.path.exists(legacy):
+                raise FileNotFoundError(f'No {kind} calibration in {self.directory}')
+            return self.load(legacy)
+        times = [t for t, path in entries]
+        upper = int(np.searchsorted(times, integrationTime))
+        if upper < len(times) and times[upper] == integrationTime:
+            return self.load(entries[upper][1])
+        if upper == 0 or upper == len(times) or not interpolate:
+            nearest = min(range(len(times)), key=lambda i: abs(times[i] - integrationTime))
+            return self.load(entries[nearest][1])
+        (t0, path0), (t1, path1) = entries[upper - 1], entries[upper]
+        w = np.float32((integrationTime - t0) / (t1 - t0))
+
+        def blend():
+            low, high = self.load(path0), self.load(path1)
+            out = np.multiply(low, 1 - w, dtype=np.float32)
+            out += w * high.astype(np.float32)
+            return out
+        return self.cached((kind, formatKey(pixelFormat), float(integrationTime)), blend)
+
+    def dark(self, integrationTime=None, pixelFormat=None, interpolate=True):
+        return self.table('darks', integrationTime, pixelFormat, interpolate)
+
+    def gain(self, integrationTime=None, pixelFormat=None, interpolate=True):
+        return self.table('radioCal', integrationTime, pixelFormat, interpolate)
+
+    '''
+    Saves darks taken at integrationTime so later scenes at that exposure (or
+    near it) can use them, replacing any cached copy
+    '''
+    def saveDark(self, dark, integrationTime, pixelFormat) -> str:
+        path = os.path.join(self.directory, tableName('darks', integrationTime, pixelFormat))
+        np.save(path, dark)
+        with self.lock:
+            # drop the old table and anything interpolated from it
+            for key in [k for k in self.cache if k == path or (isinstance(k, tuple) and k[0] == 'darks')]:
+                self.cachedBytes -= tableBytes(self.cache.pop(key))
+        self.index = None
+        return path
+
+    # spectral resampling operator for the detector width, see processing
+    def resamplingOperator(self, columns, calibrationFile='spectralCal.npy'):
+        import processing
+        path = os.path.join(self.directory, calibrationFile)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return self.cached(('spectral', path, columns),
+                           lambda: processing.loadResamplingOperator(path, columns))
+
+    '''
+    PCA / MNF reduction for cubes with these settings, fitted to cube the first
+    time after the calibration changed and saved as reduction_<method>_<n>.npz,
+    later scenes reuse it instead of refitting. Without calibration files the
+    scenes aren't on a common scale, so every cube gets its own fit.
+    '''
+    def reduction(self, cube, components=20, method='mnf'):
+        import reduction
+        calibrated = self.calibrationTime()
+        if calibrated == 0:
+            return reduction.fitReduction(cube, components, method)
+        path = os.path.join(self.directory, f'reduction_{method}_{components}.npz')
+
+        def make():
+            if os.path.exists(path) and os.path.getmtime(path) >= calibrated:
+                fitted = reduction.Reduction.load(path)
+                if fitted.mean.shape[0] == cube.shape[2]:
+                    return fitted
+            fitted = reduction.fitReduction(cube, components, method)
+            fitted.save(path)
+            return fitted
+        return self.cached(('reduction', method, components, cube.shape[2], calibrated), make)
+
+    # last time any radiometric or spectral calibration file changed, 0 if none
+    def calibrationTime(self) -> float:
+        paths = [os.path.join(self.directory, name) for name in ('radioCal.npy', 'spectralCal.npy')]
+        for kind, pixelFormat in list((self.index or self.scan()).keys()):
+            if kind == 'radioCal':
+                paths += [path for t, path in self.index[(kind, pixelFormat)]]
+        return max([os.path.getmtime(path) for path in paths if os.path.exists(path)], default=0)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.cache.clear()
+            self.cachedBytes = 0
+        self.index = None
+
+# in memory size of a table, sparse operators count their three arrays
+def tableBytes(value) -> int:
+    if hasattr(value, 'indptr'):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    if hasattr(value, 'inverseMatrix'):
+        return value.mean.nbytes + value.matrix.nbytes + value.inverseMatrix.nbytes
+    return value.nbytes
+
+_store = None
+
+def getStore() -> CalibrationStore:
+    global _store
+    if _store is None:
+        _store = CalibrationStore()
+    return _store
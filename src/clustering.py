@@ -0,0 +1,242 @@
+'''
+Clustering of hyperspectral cubes, a float32 mini-batch k-means that returns
+the same (class map, centers) pair as spectral.kmeans
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# pixels per chunk when assigning the whole cube, a few MB of float32 per chunk
+CHUNK_PIXELS = 16384
+
+'''
+Pixels of a [rows, frames, bands] cube (or an already flat [pixels, bands]
+array) as a [pixels, bands] view, no copy for contiguous arrays and memmaps
+'''
+def flattenPixels(image):
+    image = np.asarray(image)
+    return image.reshape(-1, image.shape[-1])
+
+'''
+Squared distance from every pixel to every center through one matrix product,
+||x||^2 - 2 x.c + ||c||^2. Without xNorm the ||x||^2 term is left out, which
+doesn't change the nearest center.
+'''
+def distances(x, centers, centerNorm, xNorm=None):
+    d = x @ centers.T
+    d *= -2
+    d += centerNorm
+    if xNorm is not None:
+        d += xNorm[:, np.newaxis]
+        np.maximum(d, 0, out=d)
+    return d
+
+def squaredNorm(x):
+    return np.einsum('ij,ij->i', x, x)
+
+# nearest center of each pixel in x, and its squared distance when wanted
+def assign(x, centers, centerNorm=None, withDistance=False):
+    if centerNorm is None:
+        centerNorm = squaredNorm(centers)
+    xNorm = squaredNorm(x) if withDistance else None
+    d = distances(x, centers, centerNorm, xNorm)
+    labels = np.argmin(d, axis=1)
+    if withDistance:
+        return labels, d[np.arange(len(x)), labels]
+    return labels
+
+'''
+k-means++ seeding on the float32 sample x. Seeding continues from initial
+centers when given (so k centers can grow out of a k-1 solution).
+'''
+def kmeansPlusPlus(x, k, rng, initial=None):
+    if initial is None or len(initial) == 0:
+        centers = [x[rng.integers(len(x))]]
+    else:
+        centers = list(initial)
+    closest = assign(x, np.array(centers), withDistance=True)[1]
+    while len(centers) < k:
+        total = closest.sum()
+        if total <= 0:
+            # every sample already sits on a center
+            index = rng.integers(len(x))
+        else:
+            index = rng.choice(len(x), p=closest / total)
+        centers.append(x[index])
+        closest = np.minimum(closest, assign(x, x[index][np.newaxis], withDistance=True)[1])
+    return np.array(centers, np.float32)
+
+'''
+Runs fn(start, end) over the pixel range in chunks on a thread pool (the matrix
+products and ufuncs release the GIL) and returns the results in order
+'''
+def mapChunks(fn, count, workers=None, chunk=CHUNK_PIXELS):
+    starts = range(0, count, chunk)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(starts) <= 1:
+        return [fn(start, min(start + chunk, count)) for start in starts]
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(lambda start: fn(start, min(start + chunk, count)), starts))
+
+'''
+Labels for every pixel against centers plus the per cluster sums, counts and
+total squared distance, chunked and in parallel
+'''
+def assignAll(pixels, centers, workers=None):
+    k = len(centers)
+    labels = np.empty(len(pixels), np.int32)
+    centerNorm = squaredNorm(centers)
+
+    def work(start, end):
+        x = np.asarray(pixels[start:end], np.float32)
+        chunkLabels, d = assign(x, centers, centerNorm, withDistance=True)
+        labels[start:end] = chunkLabels
+        # per cluster sums as a one-hot product, also a BLAS call
+        onehot = np.zeros((end - start, k), np.float32)
+        onehot[np.arange(end - start), chunkLabels] = 1
+        return onehot.T @ x, np.bincount(chunkLabels, minlength=k), float(d.sum())
+
+    results = mapChunks(work, len(pixels), workers)
+    sums = np.sum([r[0] for r in results], axis=0)
+    counts = np.sum([r[1] for r in results], axis=0)
+    inertia = sum(r[2] for r in results)
+    return labels, sums, counts, inertia
+
+'''
+Mini-batch k-means (Sculley 2010) refining centers in place: each iteration
+assigns batchSize random pixels and moves every center towards the mean of its
+batch members with a per center learning rate of 1/(pixels seen so far). Stops
+early once the centers move less than tolerance relative to their size.
+'''
+def miniBatchRefine(pixels, centers, iterations, batchSize, rng, tolerance=1e-4):
+    k = len(centers)
+    seen = np.zeros(k, np.float64)
+    for i in range(iterations):
+        index = np.sort(rng.choice(len(pixels), min(batchSize, len(pixels)), replace=False))
+        x = np.asarray(pixels[index], np.float32)
+        labels = assign(x, centers)
+        counts = np.bincount(labels, minlength=k)
+        onehot = np.zeros((len(x), k), np.float32)
+        onehot[np.arange(len(x)), labels] = 1
+        sums = onehot.T @ x
+        hit = counts > 0
+        seen[hit] += counts[hit]
+        rate = (counts[hit] / seen[hit]).astype(np.float32)[:, np.newaxis]
+        target = sums[hit] / counts[hit][:, np.newaxis]
+        shift = rate * (target - centers[hit])
+        centers[hit] += shift
+        if np.sum(shift * shift) <= tolerance ** 2 * np.sum(centers * centers):
+            break
+    return centers
+
+'''
+k-means clustering of image ([rows, frames, bands], memmaps fine) into
+nclusters classes. Centers are seeded with k-means++ and refined by mini-batch
+updates in float32, then every pixel is assigned in one chunked parallel pass
+and the centers are set to the mean of their pixels. Returns (m, c) like
+spectral.kmeans: m is the class of each pixel shaped like image without its
+band axis, c the nclusters x bands centers. max_iterations counts mini-batches.
+'''
+def kmeans(image, nclusters=10, max_iterations=20, batchSize=4096, workers=None, seed=0):
+    pixels = flattenPixels(image)
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(pixels[np.sort(rng.choice(len(pixels), min(len(pixels), max(batchSize, 50 * nclusters)),
+                                                  replace=False))], np.float32)
+    centers = kmeansPlusPlus(sample, nclusters, rng)
+    centers = miniBatchRefine(pixels, centers, max_iterations, batchSize, rng)
+    labels, sums, counts, inertia = assignAll(pixels, centers, workers)
+    hit = counts > 0
+    centers[hit] = sums[hit] / counts[hit][:, np.newaxis]
+    return labels.reshape(image.shape[:-1]), centers
+
+'''
+Lloyd iterations on an in-memory float32 sample, refining centers in place, and
+returns the labels of the sample
+'''
+def lloydRefine(x, centers, iterations, tolerance=1e-4):
+    k = len(centers)
+    onehot = np.zeros((len(x), k), np.float32)
+    for i in range(iterations):
+        labels = assign(x, centers)
+        onehot.fill(0)
+        onehot[np.arange(len(x)), labels] = 1
+        counts = onehot.sum(axis=0)
+        hit = counts > 0
+        updated = (onehot.T @ x)[hit] / counts[hit][:, np.newaxis]
+        shift = np.sum((updated - centers[hit]) ** 2)
+        centers[hit] = updated
+        if shift <= tolerance ** 2 * np.sum(centers * centers):
+            break
+    return assign(x, centers)
+
+'''
+Mean silhouette of labels over the points whose pairwise distance matrix is
+given, one product with the one-hot labels gives every point's summed distance
+to every cluster
+'''
+def silhouette(pairwise, labels, k):
+    onehot = np.zeros((len(labels), k), np.float32)
+    onehot[np.arange(len(labels)), labels] = 1
+    counts = onehot.sum(axis=0)
+    totals = pairwise @ onehot
+    own = totals[np.arange(len(labels)), labels]
+    ownCount = counts[labels] - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = np.where(ownCount > 0, own / ownCount, 0)
+        means = totals / counts
+    means[np.arange(len(labels)), labels] = np.inf
+    means[:, counts == 0] = np.inf
+    b = means.min(axis=1)
+    s = np.where(ownCount > 0, (b - a) / np.maximum(a, b), 0)
+    return float(np.mean(s[np.isfinite(s)]))
+
+'''
+Clusters image for every class count in counts from one shared pixel sample.
+Seeds are nested: the k-means++ seeds for k are those for k-1 plus one more,
+so each count starts from the previous one's centers instead of from scratch.
+Then all counts are refined at the same time on a thread pool and scored on the
+sample by inertia (total squared distance to the centers, lower is tighter) and
+silhouette (on a smaller subsample, -1 to 1, higher is better separated).
+Returns {k: {'centers', 'inertia', 'silhouette'}}.
+'''
+def kmeansSweep(image, counts=range(2, 11), max_iterations=30, sampleSize=10000, silhouetteSize=2000,
+                workers=None, seed=0):
+    pixels = flattenPixels(image)
+    rng = np.random.default_rng(seed)
+    index = np.sort(rng.choice(len(pixels), min(len(pixels), sampleSize), replace=False))
+    sample = np.asarray(pixels[index], np.float32)
+    counts = sorted(counts)
+    seeds = {}
+    centers = None
+    for k in counts:
+        centers = kmeansPlusPlus(sample, k, rng, centers)
+        seeds[k] = centers.copy()
+
+    # distances between the silhouette points are the same for every k; the
+    # sample is sorted by pixel index, so take a random subset, not the first rows
+    scoredIndex = rng.permutation(len(sample))[:silhouetteSize]
+    scored = sample[scoredIndex]
+    norm = squaredNorm(scored)
+    pairwise = distances(scored, scored, norm, norm)
+    np.sqrt(pairwise, out=pairwise)
+
+    def fit(k):
+        centers = seeds[k]
+        labels = lloydRefine(sample, centers, max_iterations)
+        d = assign(sample, centers, withDistance=True)[1]
+        return k, {'centers': centers, 'inertia': float(d.sum()),
+                   'silhouette': silhouette(pairwise, labels[scoredIndex], k)}
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max(1, min(workers, len(counts)))) as pool:
+        return dict(pool.map(fit, counts))
+
+# class count with the best silhouette in a kmeansSweep result, nan scores ignored
+def bestCount(sweep):
+    scored = [k for k in sweep if np.isfinite(sweep[k]['silhouette'])]
+    if not scored:
+        raise ValueError('No class count has a silhouette score')
+    return max(scored, key=lambda k: sweep[k]['silhouette'])
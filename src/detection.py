@@ -0,0 +1,202 @@
+'''
+Target and anomaly detection on hyperspectral cubes, for marking camouflage
+in the main window
+'''
+
+import numpy as np
+from reduction import CovarianceAccumulator, CHUNK_ROWS
+
+'''
+Lower Cholesky factor of covariance, with a small ridge added so a singular
+covariance (dead bands, fewer pixels than bands) still factors
+'''
+def choleskyFactor(covariance):
+    bands = covariance.shape[0]
+    ridge = np.trace(covariance) / bands * 1e-6 + 1e-12
+    return np.linalg.cholesky(covariance + np.eye(bands) * ridge)
+
+class RXDetector:
+    '''
+    Reed-Xiaoli anomaly detector: the score of a spectrum x is its Mahalanobis
+    distance (x - mean)' C^-1 (x - mean) from the background. The Cholesky factor
+    L of C is computed once, so scoring a batch of pixels is one triangular solve
+    L z = (x - mean) for all of them and a sum of squares, no inverse is formed.
+    '''
+    def __init__(self, mean, covariance) -> None:
+        self.mean = np.asarray(mean, np.float64)
+        self.factor = choleskyFactor(np.asarray(covariance, np.float64))
+
+    @staticmethod
+    def fromStatistics(statistics):
+        return RXDetector(statistics.mean(), statistics.covariance())
+
+    # background statistics from one streaming pass over a [rows, frames, bands] cube
+    @staticmethod
+    def fit(cube):
+        statistics = CovarianceAccumulator(cube.shape[2])
+        for start in range(0, cube.shape[0], CHUNK_ROWS):
+            statistics.add(cube[start:start + CHUNK_ROWS])
+        return RXDetector.fromStatistics(statistics)
+
+    # scores of a [pixels, bands] batch
+    def scorePixels(self, pixels):
+        from scipy.linalg import solve_triangular
+        d = np.asarray(pixels, np.float64) - self.mean
+        z = solve_triangular(self.factor, d.T, lower=True, check_finite=False)
+        return np.einsum('ij,ij->j', z, z).astype(np.float32)
+
+    # [rows, frames] float32 scores of a cube, a chunk of rows at a time
+    def score(self, cube, out=None):
+        rows, frames, bands = cube.shape
+        if out is None:
+            out = np.empty((rows, frames), np.float32)
+        for start in range(0, rows, CHUNK_ROWS):
+            block = np.asarray(cube[start:start + CHUNK_ROWS]).reshape(-1, bands)
+            out[start:start + CHUNK_ROWS] = self.scorePixels(block).reshape(-1, frames)
+        return out
+
+'''
+Local RX: each scan column is scored against the background of the columns
+within window of it, leaving out the guard columns on either side (and the
+column itself) so a target doesn't end up in its own background. Per column
+sums and outer products are prefix summed once, so every window's statistics
+cost one subtraction; the bands x bands products per column make this meant for
+reduced cubes (HyperSpectralCube.reduce), not raw 700 band ones.
+'''
+def localRXScores(cube, window=15, guard=1):
+    rows, frames, bands = cube.shape
+    sums = np.zeros((frames + 1, bands), np.float64)
+    products = np.zeros((frames + 1, bands, bands), np.float64)
+    shift = np.asarray(cube[:, 0, :], np.float64).mean(axis=0)
+    for j in range(frames):
+        column = np.asarray(cube[:, j, :], np.float64) - shift
+        sums[j + 1] = sums[j] + column.sum(axis=0)
+        products[j + 1] = products[j] + column.T @ column
+    out = np.empty((rows, frames), np.float32)
+    for j in range(frames):
+        outer = (max(0, j - window), min(frames, j + window + 1))
+        inner = (max(0, j - guard), min(frames, j + guard + 1))
+        count = rows * ((outer[1] - outer[0]) - (inner[1] - inner[0]))
+        if count <= 1:
+            # window too small to hold any background, use the whole scan
+            outer, inner, count = (0, frames), (0, 0), rows * frames
+        total = sums[outer[1]] - sums[outer[0]] - (sums[inner[1]] - sums[inner[0]])
+        product = products[outer[1]] - products[outer[0]] - (products[inner[1]] - products[inner[0]])
+        mean = total / count
+        covariance = product / count - np.outer(mean, mean)
+        detector = RXDetector(mean + shift, covariance)
+        out[:, j] = detector.scorePixels(cube[:, j, :])
+    return out
+
+class IncrementalRX:
+    '''
+    RX scoring while a scan is still coming in. Each new column (rows x bands)
+    is scored against the background of the columns before it and then added
+    to that background; the Cholesky factor is only refreshed every refresh
+    columns, so keeping up with the scan costs a triangular solve per column.
+    Columns arriving before there are minPixels of background score nan.
+    '''
+    def __init__(self, bands, refresh=4, minPixels=None) -> None:
+        self.statistics = CovarianceAccumulator(bands)
+        self.refresh = refresh
+        self.minPixels = 2 * bands if minPixels is None else minPixels
+        self.detector = None
+        self.pending = 0
+
+    def addColumn(self, column):
+        column = np.asarray(column)
+        if self.detector is None or self.pending >= self.refresh:
+            if self.statistics.count >= self.minPixels:
+                self.detector = RXDetector.fromStatistics(self.statistics)
+                self.pending = 0
+        if self.detector is None:
+            scores = np.full(column.shape[0], np.nan, np.float32)
+        else:
+            scores = self.detector.scorePixels(column)
+        self.statistics.add(column)
+        self.pending += 1
+        return scores
+
+'''
+Score above which a pixel is marked anomalous. RX scores of a Gaussian
+background follow a chi-square distribution with one degree of freedom per
+band, so a pixel has to score above its 1 - falseAlarm point; a scene without
+targets then marks next to nothing. Real backgrounds have heavier tails, so
+the threshold is also never below the fraction quantile of the scores (nan
+scores ignored), which caps the marked pixels at 1 - fraction. nan if no score
+is finite.
+'''
+def anomalyThreshold(scores, bands, falseAlarm=1e-4, fraction=0.999):
+    from scipy.stats import chi2
+    scores = np.asarray(scores)
+    if not np.isfinite(scores).any():
+        return np.nan
+    return float(max(chi2.isf(falseAlarm, bands), np.nanquantile(scores, fraction)))
+
+class LibraryMatcher:
+    '''
+    Scores every pixel against every spectrum of a library (cluster centers or
+    lab measured targets, library x bands) with one matrix product per chunk of
+    rows, so hundreds of spectra cost about the same pass over the cube as one.
+    'sam' is the spectral angle mapper: the angle in radians between the pixel
+    and the library spectrum, insensitive to brightness, lower is closer.
+    'amf' is the adaptive matched filter against the background: the filters
+    C^-1 (t - mean) / ((t - mean)' C^-1 (t - mean)) are solved once through the
+    Cholesky factor, and a pixel scores 1 when it looks like the target and 0
+    when it looks like background, higher is closer.
+    '''
+    def __init__(self, library, method='sam', background=None) -> None:
+        library = np.atleast_2d(np.asarray(library, np.float64))
+        if method not in ('sam', 'amf'):
+            raise ValueError('Unknown matching method: ' + method)
+        self.method = method
+        if method == 'sam':
+            norm = np.linalg.norm(library, axis=1, keepdims=True)
+            self.filters = (library / np.where(norm > 0, norm, 1)).T.astype(np.float32)
+            self.offset = 0
+        else:
+            if background is None:
+                raise ValueError('amf needs the background (an RXDetector)')
+            from scipy.linalg import cho_solve
+            targets = (library - background.mean).T
+            whitened = cho_solve((background.factor, True), targets, check_finite=False)
+            energy = np.einsum('ij,ij->j', targets, whitened)
+            self.filters = (whitened / np.where(energy > 0, energy, 1)).astype(np.float32)
+            self.offset = (background.mean @ self.filters).astype(np.float32)
+
+    # [pixels, library] scores of a [pixels, bands] batch, see the class docs
+    def scorePixels(self, pixels):
+        x = np.asarray(pixels, np.float32)
+        scores = x @ self.filters
+        if self.method == 'sam':
+            norm = np.sqrt(np.einsum('ij,ij->i', x, x))
+            scores /= np.where(norm > 0, norm, 1)[:, np.newaxis]
+            np.clip(scores, -1, 1, out=scores)
+            np.arccos(scores, out=scores)
+        else:
+            scores -= self.offset
+        return scores
+
+    '''
+    Best library entry of every pixel and its score, two [rows, frames] maps,
+    computed a chunk of rows at a time
+    '''
+    def match(self, cube):
+        rows, frames, bands = cube.shape
+        best = np.empty((rows, frames), np.int32)
+        score = np.empty((rows, frames), np.float32)
+        for start in range(0, rows, CHUNK_ROWS):
+            scores = self.scorePixels(np.asarray(cube[start:start + CHUNK_ROWS]).reshape(-1, bands))
+            index = np.argmin(scores, axis=1) if self.method == 'sam' else np.argmax(scores, axis=1)
+            best[start:start + CHUNK_ROWS] = index.reshape(-1, frames)
+            score[start:start + CHUNK_ROWS] = scores[np.arange(len(scores)), index].reshape(-1, frames)
+        return best, score
+
+'''
+Pixels that match their best library entry: spectral angle under threshold
+radians for sam, matched filter output over threshold for amf
+'''
+def matchMask(score, method='sam', threshold=None):
+    if method == 'sam':
+        return score < (0.1 if threshold is None else threshold)
+    return score > (0.5 if threshold is None else threshold)
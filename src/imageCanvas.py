@@ -0,0 +1,118 @@
+'''
+Matplotlib canvas for the main window, kept in its own module so matplotlib is
+only imported the first time something is drawn
+'''
+
+import numpy as np
+import detection
+from PyQt5.QtCore import QObject, QTimer, pyqtSlot
+import matplotlib
+matplotlib.use('Qt5Agg')
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.figure import Figure
+
+'''
+Class to display the graphic and spectra on the GUI
+'''
+class ImageCanvas(FigureCanvas):
+    def __init__(self, parent=None, width=5, height=4, dpi=100):
+        self.fig = Figure(figsize=(width, height), dpi=dpi)
+        super().__init__(self.fig)
+        self.axes = self.fig.add_subplot(111)
+        self.axes.axis('off')
+        self.fig.subplots_adjust(left=0, right=1, top=1, bottom=0)
+
+    '''
+    Images are drawn into one persistent AxesImage: if the new image has the
+    same shape as the one on screen only its data, colormap and limits change,
+    which is far cheaper than clearing and re-plotting the axes.
+    '''
+    def plot_image(self, image, mode='image', cmap='gray'):
+        if mode == 'image':
+            current = getattr(self, 'image', None)
+            if current is not None and current.get_array().shape == np.shape(image):
+                current.set_data(image)
+                current.set_cmap(cmap)
+                current.autoscale()
+            else:
+                self.axes.clear()  # Clear the previous plot
+                self.axes.axis('off')
+                self.image = self.axes.imshow(image, cmap, aspect='auto')
+                self.overlay = None
+        elif mode == 'spectrum':
+            self.axes.clear()  # Clear the previous plot
+            self.image = None
+            self.overlay = None
+            wavelengths = np.arange(450, 961, 15)
+            #data = np.array([1]) # need to change to get the spectra of the camoflauged pixels
+            #self.axes.plot(wavelengths, data)
+        self.draw_idle()
+
+    '''
+    Marks the pixels where mask is set in colour over the current image, in a
+    second persistent AxesImage so the image underneath is left alone
+    '''
+    def plot_overlay(self, mask, color=(1, 0, 0), alpha=0.8):
+        rgba = np.zeros(np.shape(mask) + (4,), np.float32)
+        rgba[..., :3] = color
+        rgba[..., 3] = np.where(mask, alpha, 0)
+        current = getattr(self, 'overlay', None)
+        if current is not None and current.get_array().shape == rgba.shape:
+            current.set_data(rgba)
+        else:
+            if current is not None:
+                current.remove()
+            self.overlay = self.axes.imshow(rgba, aspect='auto', interpolation='nearest')
+        self.draw_idle()
+
+class LivePreview(QObject):
+    '''
+    Quick look of a scan while it is running. Each step's frame (rows x columns)
+    is collapsed to one column of a rows x steps preview (mean over the spectral
+    columns, every rowStep-th row) as it arrives, and the canvas is redrawn from
+    a timer at most fps times a second no matter how fast steps come in.
+    The same rows, binned to rxBands bands, are scored by an IncrementalRX
+    against the columns before them, and pixels over the anomaly threshold are
+    marked on the preview while the scan is still running.
+    '''
+    def __init__(self, canvas, steps, fps=10, maxRows=256, rxBands=32) -> None:
+        super().__init__()
+        self.canvas = canvas
+        self.steps = steps
+        self.maxRows = maxRows
+        self.rxBands = rxBands
+        self.preview = None
+        self.dirty = False
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.redraw)
+        self.timer.start(int(1000 / fps))
+
+    @pyqtSlot(int, object)
+    def addStep(self, index, frame) -> None:
+        if self.preview is None:
+            self.rowStep = max(1, frame.shape[0] // self.maxRows)
+            rows = len(range(0, frame.shape[0], self.rowStep))
+            self.preview = np.zeros((rows, self.steps), np.float32)
+            self.scores = np.full((rows, self.steps), np.nan, np.float32)
+            self.rxBands = min(self.rxBands, frame.shape[1])
+            self.rx = detection.IncrementalRX(self.rxBands)
+        pixels = frame[::self.rowStep, :]
+        np.mean(pixels, axis=1, out=self.preview[:, index])
+        width = pixels.shape[1] // self.rxBands
+        spectra = pixels[:, :width * self.rxBands].reshape(len(pixels), self.rxBands, width).mean(axis=2)
+        self.scores[:, index] = self.rx.addColumn(spectra)
+        self.dirty = True
+
+    def redraw(self) -> None:
+        if not self.dirty:
+            return
+        self.dirty = False
+        self.canvas.plot_image(self.preview, cmap='gray')
+        threshold = detection.anomalyThreshold(self.scores, self.rxBands)
+        if np.isfinite(threshold):
+            with np.errstate(invalid='ignore'):
+                self.canvas.plot_overlay(self.scores > threshold)
+
+    def stop(self) -> None:
+        self.timer.stop()
+        self.redraw()
@@ -2,22 +2,45 @@
 This is the basis for the GUI layout
 '''
 
+import time
+# taken before the heavy imports so startup time covers them
+startupTime = time.perf_counter()
+import os
 import sys
 import re
-import time
 import math
 import copy
 import Camera
 import numpy as np
 import DM542t as Driver
-from spectral import *
 from PyQt5 import uic, QtCore
-from PyQt5.QtCore import pyqtSignal, QEventLoop, QObject
+from PyQt5.QtCore import pyqtSignal, QObject, QThread, QTimer
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QGraphicsView
-import matplotlib
-matplotlib.use('Qt5Agg')
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
+
+# spectral, matplotlib and the hardware libraries are imported where they are
+# first used so the main window comes up without waiting on them
+
+# generated form classes, each .ui file is only parsed once per run
+uiClasses = {}
+
+'''
+Same as uic.loadUi(fileName, widget) but the .ui file is compiled to a form
+class once and reused, so opening a window a second time doesn't re-parse XML
+'''
+def loadUi(fileName, widget):
+    if fileName not in uiClasses:
+        uiClasses[fileName] = uic.loadUiType(fileName)[0]
+    form = uiClasses[fileName]()
+    form.setupUi(widget)
+    # put the child widgets on the widget itself like uic.loadUi does
+    for name, value in vars(form).items():
+        setattr(widget, name, value)
+
+# compiles the other windows' layouts while the main window sits idle
+def preloadUi():
+    for fileName in ('imageInfo.ui', 'imageProgress.ui', 'darkImageWindow.ui'):
+        if fileName not in uiClasses:
+            uiClasses[fileName] = uic.loadUiType(fileName)[0]
 
 '''
 Class for updating progress on current image
@@ -26,7 +49,7 @@ Features a ui design with a progress bar and cancellation button
 class ImageProgress(QWidget):
     def __init__(self, c, parent=None):
         super().__init__(parent)
-        uic.loadUi('imageProgress.ui', self)
+        loadUi('imageProgress.ui', self)
         self.setWindowTitle("Image Progress")
         self.camera = c
         self.cancelButton.clicked.connect(self.cancel)
@@ -57,19 +80,48 @@ Window to put on enclosure cap for dark subtract image
 class DarkWindow(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
-        uic.loadUi('darkImageWindow.ui', self)
+        loadUi('darkImageWindow.ui', self)
         self.setWindowTitle('Enclosure Cap Close')
 
+'''
+Returns the file a scan should be streamed into while it is taken, or None
+when the name is not a cube format we can memory-map. Lab calibration keeps
+the raw cube under the requested name, otherwise the raw cube goes next to it
+(name_raw.npy) and the requested name is left for the processed image.
+'''
+def scanFileName(fileName, labCalibration):
+    root, ext = os.path.splitext(fileName)
+    if ext.lower() not in ('.npy', '.hdr'):
+        return None
+    if labCalibration:
+        return fileName
+    return root + '_raw' + ext
+
+'''
+Saves an image under fileName in the format its extension asks for, an ENVI
+image for .hdr and a .npy file otherwise
+'''
+def saveImage(fileName, image):
+    if fileName.lower().endswith('.hdr'):
+        from spectral import envi
+        envi.save_image(fileName, np.asarray(image), force=True)
+    else:
+        np.save(fileName, image)
+
 '''
 Class is for receiving user input about the image process, including the integration
 time, FOR range, fileName, calibration use
 '''
 class ImageInfo(QWidget):
     dataCollected = pyqtSignal(object, bool, bool, str)
+    # camera and number of steps, emitted as a scene scan starts
+    scanStarted = pyqtSignal(object, int)
+    # emitted once the scene scan is over (done or failed), before any dark scan
+    scanEnded = pyqtSignal()
 
     def __init__(self, parent=None):
         super().__init__(parent)
-        uic.loadUi('imageInfo.ui', self)
+        loadUi('imageInfo.ui', self)
         self.setWindowTitle("Imaging Spectrometer Image Info")
 
         self.setPlaceholders()
@@ -131,8 +183,13 @@ class ImageInfo(QWidget):
     Valid Input:
         Integration input can be converted to an integer and is between 30-1e7
         If valid set validTime to true and integrationTime to the valid time
+        'auto' is also valid and lets the camera find its own integration time
     '''
     def validateIntegrationTime(self):
+        if self.integrationTimeLineEdit.text().strip().lower() == 'auto':
+            self.validTime = True
+            self.integrationTime = None
+            return
         try:
             integration = int(self.integrationTimeLineEdit.text())
             print(integration)
@@ -152,8 +209,8 @@ class ImageInfo(QWidget):
         Validate that the filename is some valid value that ends in .npy
     '''
     def validateFileName(self):
-        # regex to match the expression to a filename that ends in .npy
-        regex = r'^.+\.npy$'
+        # regex to match the expression to a filename that ends in .npy or an ENVI .hdr
+        regex = r'^.+\.(npy|hdr)$'
         regex2 = r'^.+\.cv$'
         if bool(re.match(regex, self.fileNameLineEdit.text())):
             self.fileName = self.fileNameLineEdit.text()
@@ -170,7 +227,7 @@ class ImageInfo(QWidget):
     Resets all validities and sets all inputs to original states
     '''
     def setPlaceholders(self):
-        self.integrationTimeLineEdit.setPlaceholderText("30 - 10000000")
+        self.integrationTimeLineEdit.setPlaceholderText("30 - 10000000 or auto")
         self.minFORLineEdit.setPlaceholderText("-0.25 to 0.0")
         self.maxFORLineEdit.setPlaceholderText("0.0 to 0.25")
         self.fileNameLineEdit.setPlaceholderText("exampleName.npy")
@@ -219,16 +276,25 @@ class ImageInfo(QWidget):
         # create driver and camera
         start=time.time()
         self.driver = Driver.DM542t()
-        self.driver.reset()
+        # the worker homes the motor before scanning
         #return
         self.driver.setStepsPerImage(self.imageEverySteps*21)
         self.driver.setImagesPerScene(math.floor(self.numSteps/self.imageEverySteps))
         #self.driver.setStart(self.minFOR)
         self.camera = Camera.Camera()
         print('here')
-        self.camera.setIntegrationTime(self.integrationTime)
+        if self.integrationTime is not None:
+            self.camera.setIntegrationTime(self.integrationTime)
         print('here2')
-        self.camera.setPixelFormat('mono12')
+        # only detector columns 0-728 hold the spectrum (see ranges in
+        # initialProcess), so don't read out the rest of the sensor
+        self.camera.setROI(0, 0, 728, None)
+        # keep 12 bit pixels packed on the link (25% less bandwidth), the frames
+        # are unpacked to uint16 on the host as they arrive
+        if self.camera.hasPixelFormat('mono12p'):
+            self.camera.setPixelFormat('mono12p')
+        else:
+            self.camera.setPixelFormat('mono12')
 
         # create and displays the progress window
         self.progressWindow = ImageProgress(self.camera)
@@ -238,9 +304,44 @@ class ImageInfo(QWidget):
         self.camera.cancelledChanged.connect(self.cancellation)
         self.camera.progressChanged.connect(self.progressWindow.updateProgressBar)
 
-        # take images of the scene
+        # take images of the scene on a worker thread, streaming the cube to disk as
+        # it is taken, auto exposure runs there too (last, so it sees the final ROI
+        # and pixel format)
         self.cancelled = False
-        self.img = self.camera.scanNDArray(self.driver)
+        self.dark = None
+        self.scanStart = start
+        self.scanStarted.emit(self.camera, self.driver.getImagesPerScene())
+        self.startScan(self.sceneScanned, out=scanFileName(self.fileName, self.labCalibration),
+                       autoExposure=self.integrationTime is None, resetFirst=True)
+
+    '''
+    Runs camera.scanNDArray(driver) on a worker QThread, onFinished gets the cube
+    back on the GUI thread. Progress and cancellation arrive through the camera's
+    signals as before. Homing the motor (resetFirst, and after a cancel) happens
+    on the worker too, so motor timeouts end up in scanFailed.
+    '''
+    def startScan(self, onFinished, out=None, autoExposure=False, resetFirst=False):
+        self.scanThread = QThread()
+        self.scanWorker = Camera.ScanWorker(self.camera, self.driver, out, autoExposure, resetFirst)
+        self.scanWorker.moveToThread(self.scanThread)
+        self.scanThread.started.connect(self.scanWorker.run)
+        self.scanWorker.finished.connect(onFinished)
+        self.scanWorker.failed.connect(self.scanFailed)
+        self.scanWorker.finished.connect(self.scanThread.quit)
+        self.scanWorker.failed.connect(self.scanThread.quit)
+        self.scanThread.start()
+
+    '''
+    Use Case: Called when the worker finishes scanning the scene
+    Purpose:
+        Asks for the enclosure cap to take darks, or hands lab calibration data
+        straight to the main window
+    '''
+    @QtCore.pyqtSlot(object)
+    def sceneScanned(self, img):
+        self.img = img
+        # the dark scan's steps must not land in the scene preview
+        self.scanEnded.emit()
         #a = []
         #for i in range(5):
         #    frame = self.camera.takeFrameNDArray()
@@ -253,15 +354,13 @@ class ImageInfo(QWidget):
         #self.img = self.camera.takeFrameCV()
         #np.set_printoptions(precision=7)
         end=time.time()
-        print(f"Time:{end-start}")
+        print(f"Time:{end-self.scanStart}")
 
         self.progressWindow.close()
         if not self.cancelled and not self.labCalibration:
             self.darkSub = DarkWindow()
             self.darkSub.show()
             self.darkSub.capOnButton.clicked.connect(lambda: self.darkImages())
-            self.loop = QEventLoop()
-            self.loop.exec_()
         elif not self.cancelled:
             self.takeImageButton.setEnabled(True)
             self.dataCollected.emit(self.img, self.labCalibration, self.sceneCalibration, self.fileName)
@@ -275,19 +374,51 @@ class ImageInfo(QWidget):
         self.driver.setStepsPerImage(21)
         self.driver.setImagesPerScene(1)
         self.camera.setImagesPerStep(10)
-        self.dark = self.camera.scanNDArray(self.driver)
+        self.startScan(self.darksScanned)
+
+    @QtCore.pyqtSlot(object)
+    def darksScanned(self, dark):
+        # a cancelled continuous scan hands back no cube at all
+        if dark is None:
+            self.darkSub.close()
+            return
+        # one averaged frame, kept as rows x columns
+        self.dark = dark[:, 0, :]
+        # keep the darks for this exposure, later scenes at (or near) it reuse them
+        import calibration
+        calibration.getStore().saveDark(self.dark, self.camera.getIntegrationTime(),
+                                        self.camera.getPixelFormat())
         self.darkSub.close()
         self.takeImageButton.setEnabled(True)
         self.dataCollected.emit(self.img, self.labCalibration, self.sceneCalibration, self.fileName)
-        self.loop.quit()
+
+    '''
+    Use Case: Called by the main window when processing the collected data
+    Purpose: Darks of this scan (None for lab calibration), integration time in
+        us and pixel format the scene was taken with, for the calibration lookups
+    '''
+    def calibrationInfo(self):
+        return self.dark, self.camera.getIntegrationTime(), self.camera.getPixelFormat()
+
+    '''
+    Use Case: Called when the scan worker hits an error (camera or motor)
+    Purpose: Reports it and puts the form back so the user can try again
+    '''
+    @QtCore.pyqtSlot(str)
+    def scanFailed(self, message):
+        print('Scan failed: ' + message)
+        self.scanEnded.emit()
+        self.progressWindow.close()
+        if hasattr(self, 'darkSub'):
+            self.darkSub.close()
+        self.takeImageButton.setEnabled(True)
     '''
     Use Case: Called when camera class emits cancellation signal
     Purpose:
-        Resets the driver to inital state at -0.25 degrees
-        Closes the progress window
+        Closes the progress window, the scan worker resets the driver to
+        inital state at -0.25 degrees
     '''
     def cancellation(self):
-        self.driver.reset()
         self.progressWindow.close()
         self.cancelled = True
         self.takeImageButton.setEnabled(True)
@@ -315,27 +446,6 @@ class ProcessingWindow(QWidget):
         uic.loadUi('processingWindow.ui')
         self.setWindowTitle('Processing Occurring')
 
-'''
-Class to display the graphic and spectra on the GUI
-'''
-class ImageCanvas(FigureCanvas):
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        self.fig = Figure(figsize=(width, height), dpi=dpi)
-        super().__init__(self.fig)
-        self.axes = self.fig.add_subplot(111)
-        self.axes.axis('off')
-        self.fig.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    def plot_image(self, image, mode='image', cmap='gray'):
-        self.axes.clear()  # Clear the previous plot
-        if mode == 'image':
-            self.axes.imshow(image, cmap)
-        elif mode == 'spectrum':
-            wavelengths = np.arange(450, 961, 15)
-            #data = np.array([1]) # need to change to get the spectra of the camoflauged pixels
-            #self.axes.plot(wavelengths, data)
-        self.draw()
-
 '''
 Main Control Window: to take user input to start taking images, load or save images,
     also allows us to manipulate data to show varying spectra
@@ -344,17 +454,17 @@ class MainWindow(QMainWindow):
     def __init__(self, parent=None):
         super().__init__(parent)
 
-        uic.loadUi('mainWindow.ui', self)
+        loadUi('mainWindow.ui', self)
         self.setWindowTitle("Imaging Spectrometer Main Window")
 
         self.takePhotoButton.clicked.connect(lambda: self.imageInfoControl())
 
         # updates the image for the wavelength ranges
-        self.redButton.clicked.connect(lambda: self.updateImageOnGUI(self.image_data, 'Reds'))
-        self.greenButton.clicked.connect(lambda: self.updateImageOnGUI(self.image_data, 'Greens'))
-        self.blueButton.clicked.connect(lambda: self.updateImageOnGUI(self.image_data, 'Blues'))
-        self.irButton.clicked.connect(lambda: self.updateImageOnGUI(self.image_data, 'ir'))
-        self.overlayClassesButton.clicked.connect(lambda: self.updateImageOnGUI(self.image_data, 'overlay'))
+        self.redButton.clicked.connect(lambda: self.showBand('red', 'Reds'))
+        self.greenButton.clicked.connect(lambda: self.showBand('green', 'Greens'))
+        self.blueButton.clicked.connect(lambda: self.showBand('blue', 'Blues'))
+        self.irButton.clicked.connect(lambda: self.showBand('ir', 'gray'))
+        self.overlayClassesButton.clicked.connect(lambda: self.showAnomalies())
         # saves and loads image
         self.saveImageButton.clicked.connect(lambda: print('save image clicked'))
         self.loadImageButton.clicked.connect(lambda: print('load image clicked'))
@@ -392,8 +502,32 @@ class MainWindow(QMainWindow):
         self.imageWindow = ImageInfo()
         self.disable_buttons()
         self.imageWindow.dataCollected.connect(self.initialProcess)
+        self.imageWindow.scanStarted.connect(self.startLivePreview)
+        self.imageWindow.scanEnded.connect(self.stopLivePreview)
         self.imageWindow.show()
 
+    '''
+    Use Case: Called when a scene scan starts
+    Purpose: Shows each scan column on the image view as it comes in, so
+        framing problems show up in the first seconds of a scan
+    '''
+    @QtCore.pyqtSlot(object, int)
+    def startLivePreview(self, camera, steps):
+        from imageCanvas import LivePreview
+        self.stopLivePreview()
+        self.livePreview = LivePreview(self.getImageCanvas(), steps)
+        self.previewCamera = camera
+        camera.stepReady.connect(self.livePreview.addStep)
+        camera.cancelledChanged.connect(self.stopLivePreview)
+
+    def stopLivePreview(self):
+        if getattr(self, 'livePreview', None) is not None:
+            # later scans on the same camera (the darks) must not reach it
+            self.previewCamera.stepReady.disconnect(self.livePreview.addStep)
+            self.previewCamera.cancelledChanged.disconnect(self.stopLivePreview)
+            self.livePreview.stop()
+            self.livePreview = None
+
     '''
     Use Case: Called when the picture has been fully taken, not cancelled and recieves
     an object data which is the information collected from the camoflauge, and then
@@ -401,8 +535,13 @@ class MainWindow(QMainWindow):
     '''
     @QtCore.pyqtSlot(object, bool, bool, str)
     def initialProcess(self, data, labCalibration, sceneCalibration, fileName):
-        # deep copy the image data just incase garbage collection
-        self.image_data = copy.deepcopy(data)
+        self.stopLivePreview()
+        # deep copy the image data just incase garbage collection, a cube that
+        # was streamed to disk stays memory-mapped instead of being copied in
+        if isinstance(data, np.memmap):
+            self.image_data = data
+        else:
+            self.image_data = copy.deepcopy(data)
         self.imageWindow.close()
         self.enable_buttons()
         self.fileName = fileName
@@ -410,7 +549,9 @@ class MainWindow(QMainWindow):
         # lab calibration just show and save image for later processing
         if labCalibration:
             print(self.image_data.shape)
-            np.save(fileName, data)
+            # the scan already wrote the cube to fileName
+            if not isinstance(data, np.memmap):
+                saveImage(fileName, data)
             result = self.image_data
             self.updateImageOnGUI(result, 'gray')
             #imshow(self.image_data)
@@ -427,24 +568,18 @@ class MainWindow(QMainWindow):
             self.processingWindow.show()
             self.processingWindow.close()
             print(self.image_data.shape)
+            from spectral import imshow
             imshow(self.image_data)
 
-            # Define the ranges for the third axis
-            ranges = [(0, 182), (182, 388), (388, 560), (560, 728)]
-            # Initialize a list to store the averaged arrays
-            averaged_arrays = []
-            # Loop over the ranges
-            for start, end in ranges:
-                # Extract the subarray for the current range
-                subarray = self.image_data[:, :, start:end]
-                # Take the average over the third dimension
-                averaged_subarray = np.mean(subarray, axis=2)
-                # Append the averaged subarray to the list
-                averaged_arrays.append(averaged_subarray)
-            # Stack the averaged arrays along the third dimension
-            result = np.stack(averaged_arrays, axis=2)
+            # band means come from a prefix sum over the bands built in one pass,
+            # the colour buttons then reuse it instead of rescanning the cube
+            import processing
+            dark, integrationTime, pixelFormat = self.imageWindow.calibrationInfo()
+            self.cube = processing.HyperSpectralCube(self.image_data, dark, integrationTime, pixelFormat)
+            result = self.cube.getCompositeImage()
             self.updateImageOnGUI(result, 'color')
-            np.save(fileName, result)
+            self.showAnomalies()
+            saveImage(fileName, result)
 
     '''
     Use Cases: Called when the image is first processed to display image with marked pixels
@@ -452,14 +587,54 @@ class MainWindow(QMainWindow):
         Called when any color button is clicked to update image with specific classes
     '''
     def updateImageOnGUI(self, img, cmap):
-        self.imageCanvas = ImageCanvas(self.centralwidget)
-        layout = self.leftVerticalLayout
-        layout.itemAt(0).widget().setParent(None)
-        layout.insertWidget(0, self.imageCanvas, stretch=3)
+        canvas = self.getImageCanvas()
         if cmap == 'color':
-            self.imageCanvas.plot_image(img)
+            canvas.plot_image(img)
         else:
-            self.imageCanvas.plot_image(img, cmap)
+            canvas.plot_image(img, cmap=cmap)
+
+    '''
+    Use Case: Called when a colour button is clicked, shows the mean over that band
+    from the processed cube (cached after the first click)
+    '''
+    def showBand(self, band, cmap):
+        if getattr(self, 'cube', None) is None:
+            return
+        self.updateImageOnGUI(self.cube.getBand(band), cmap)
+
+    '''
+    Use Case: Called when the scene is processed and when overlay classes is clicked
+    Purpose: Marks the pixels that stand out from the background (RX anomaly
+        score in the top 0.1%) over the image, likely camoflauge, along with
+        the pixels matching a lab measured target in targetLibrary.npy if there is one
+    '''
+    def showAnomalies(self):
+        if getattr(self, 'cube', None) is None:
+            return
+        import detection
+        scores = self.cube.anomalies
+        if scores is None:
+            scores = self.cube.detectAnomalies()
+        mask = scores > detection.anomalyThreshold(scores, self.cube.anomalyBands)
+        if os.path.exists('targetLibrary.npy'):
+            if getattr(self.cube, 'matches', None) is None:
+                self.cube.matchLibrary(np.load('targetLibrary.npy'), 'sam')
+            best, angle = self.cube.matches
+            mask |= detection.matchMask(angle, 'sam')
+        self.getImageCanvas().plot_overlay(mask)
+
+    '''
+    The image view is created the first time it is needed and then kept, later
+    images are drawn into the same canvas
+    '''
+    def getImageCanvas(self):
+        if getattr(self, 'imageCanvas', None) is None:
+            from imageCanvas import ImageCanvas
+            self.imageCanvas = ImageCanvas(self.centralwidget)
+            layout = self.leftVerticalLayout
+            layout.itemAt(0).widget().setParent(None)
+            layout.insertWidget(0, self.imageCanvas, stretch=3)
+        return self.imageCanvas
 
 
     '''
@@ -471,11 +646,14 @@ class MainWindow(QMainWindow):
         likely need to change this so that we graph spectral data of the camoflauge
         may need to change the imagecanvas class possibly
         '''
-        self.imageCanvas = ImageCanvas(self.centralwidget)
-        layout = self.rightVerticalLayout
-        layout.itemAt(0).widget.setParent(None)
-        layout.insertWidget(0, self.imageCanvas, stretch=3)
-        self.imageCanvas.plot_image(data, mode='spectrum')
+        # kept separate from imageCanvas so the image view isn't replaced
+        if getattr(self, 'graphCanvas', None) is None:
+            from imageCanvas import ImageCanvas
+            self.graphCanvas = ImageCanvas(self.centralwidget)
+            layout = self.rightVerticalLayout
+            layout.itemAt(0).widget().setParent(None)
+            layout.insertWidget(0, self.graphCanvas, stretch=3)
+        self.graphCanvas.plot_image(data, mode='spectrum')
 
     '''
     Use Case: Called when save image is clicked, saving the processed image, which has been
@@ -483,7 +661,7 @@ class MainWindow(QMainWindow):
     '''
     def saveImageProcess(self):
         # replace self.img with whatever the actual name of the final processed image is
-        np.save(self.fileName, self.img)
+        saveImage(self.fileName, self.img)
 
     '''
     Use Case: Called when load image is clicked, opening a new window asking for fileName
@@ -493,12 +671,18 @@ class MainWindow(QMainWindow):
     def loadImageProcess(self):
         # create a new window to ask for filename, open and
         # run processing, don't have to do mappings here, just do classification
-        # self.final = np.load(fileName)
+        # open lazily so large scans are not read into memory up front
+        # self.final = acquisition.openCubeFile(fileName)
         pass
 
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
+    # the camera stays open for the whole run, release it once on exit
+    app.aboutToQuit.connect(Camera.closeSession)
     win = MainWindow()
     win.show()
+    # runs once the event loop is up, i.e. when the window is interactive
+    QTimer.singleShot(0, lambda: print(f"Startup: {time.perf_counter() - startupTime:.2f}s"))
+    QTimer.singleShot(0, preloadUi)
     sys.exit(app.exec())
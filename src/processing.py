@@ -2,15 +2,234 @@
 This is the basis for handling the information with spectral etc
 '''
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from spectral import *
+import clustering
+import detection
+
+# detector column ranges of the four display bands, the spectral axis is the last one
+BAND_RANGES = {'blue': (0, 182), 'green': (182, 388), 'red': (388, 560), 'ir': (560, 728)}
+# the same bands in nm, for cubes resampled onto the wavelength grid
+BAND_WAVELENGTHS = {'blue': (450, 495), 'green': (495, 570), 'red': (620, 700), 'ir': (700, 950)}
+
+class BandIndex():
+    '''
+    Prefix sum of a [rows, frames, bands] cube along the band axis, built once in
+    a single pass. The mean over any band range is then one subtraction of two
+    [rows, frames] planes instead of a pass over the whole cube, and each range
+    is cached after the first request. Integer cubes are summed in uint32 when
+    that can't overflow (12 bit data over ~1000 bands fits) to keep memory down.
+    '''
+    def __init__(self, cube, wavelengths=None):
+        rows, frames, bands = cube.shape
+        if np.issubdtype(cube.dtype, np.integer) and np.iinfo(cube.dtype).max * bands < 2**32:
+            dtype = np.uint32
+        elif np.issubdtype(cube.dtype, np.integer):
+            dtype = np.int64
+        else:
+            dtype = np.float64
+        self.sums = np.zeros((rows, frames, bands + 1), dtype)
+        np.cumsum(cube, axis=2, dtype=dtype, out=self.sums[:, :, 1:])
+        self.bands = bands
+        # wavelength of every band, once spectral calibration has been applied
+        self.wavelengths = None if wavelengths is None else np.asarray(wavelengths)
+        self.cache = {}
+
+    '''
+    Mean over bands start up to (not including) end, as float32 [rows, frames].
+    The range is clamped to the cube (a binned ROI or the wavelength grid can
+    have fewer bands than the detector ranges assume) and always holds at
+    least one band.
+    '''
+    def mean(self, start, end):
+        start = max(0, min(start, self.bands - 1))
+        end = max(start + 1, min(end, self.bands))
+        key = (start, end)
+        if key not in self.cache:
+            total = np.subtract(self.sums[:, :, end], self.sums[:, :, start], dtype=np.float64)
+            self.cache[key] = (total / (end - start)).astype(np.float32)
+        return self.cache[key]
+
+    # mean over a wavelength range in nm, needs wavelengths
+    def wavelengthMean(self, low, high):
+        if self.wavelengths is None:
+            raise ValueError('No wavelengths, apply the spectral calibration first')
+        start = int(np.searchsorted(self.wavelengths, low, side='left'))
+        end = int(np.searchsorted(self.wavelengths, high, side='right'))
+        return self.mean(start, end)
+
+    # [rows, frames, len(ranges)] stack of band means
+    def composite(self, ranges):
+        return np.stack([self.mean(start, end) for start, end in ranges], axis=2)
+
+# detector pixels are 6um square, the lens is F/5
+PIXEL_AREA = 0.006 ** 2 # mm^2
+F_NUMBER = 5
+# float32 working set per chunk of rows, small enough to stay in cache
+CHUNK_BYTES = 2 ** 21
+
+'''
+Factor from (value - dark) * gain (power per pixel) to radiance: divide by the
+pixel area for irradiance and by the lens solid angle sr = pi/(4*(F/#)^2)
+'''
+def radianceScale(pixelArea=PIXEL_AREA, fNumber=F_NUMBER):
+    sr = np.pi / (4 * fNumber ** 2)
+    return 1.0 / (pixelArea * sr)
+
+'''
+A dark or gain table as a [rows, 1 or frames, bands] view, so slicing it by rows
+lines up with the cube: scalars and [bands] tables apply to every row, [rows,
+bands] ones to every frame. Shapes that don't fit raise ValueError.
+'''
+def rowTable(table, rows, bands):
+    table = np.asarray(table)
+    if table.ndim < 2:
+        table = table.reshape(1, 1, -1)
+    elif table.ndim == 2:
+        table = table[:, np.newaxis, :]
+    return np.broadcast_to(table, (rows, table.shape[1], bands))
+
+'''
+Radiometric correction of a [rows, frames, bands] cube, (cube - dark) * gain * scale,
+as one fused pass in float32. dark and gain are each a scalar, [bands],
+[rows, bands] or [rows, 1 or frames, bands] (see rowTable). The cube is worked through a few rows at a
+time, each chunk is subtracted straight into its slice of out and scaled there,
+so besides out nothing cube sized is allocated and a memory-mapped cube larger
+than RAM is only ever read one chunk at a time. out can be an array, a .npy
+path to stream the result to, or None for a new float32 array. Chunks are
+spread over workers threads (numpy releases the GIL inside the ufuncs).
+'''
+def radiometricCorrect(cube, dark, gain, scale=None, out=None, workers=None):
+    rows, frames, bands = cube.shape
+    if scale is None:
+        scale = radianceScale()
+    dark = rowTable(dark, rows, bands)
+    # gain and scale folded into one factor so each element is touched twice
+    factor = rowTable(np.asarray(gain, np.float32) * np.float32(scale), rows, bands)
+    if out is None:
+        out = np.empty(cube.shape, np.float32)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=cube.shape)
+    step = max(1, CHUNK_BYTES // (frames * bands * 4))
+
+    def correct(start):
+        end = min(start + step, rows)
+        block = out[start:end]
+        np.subtract(cube[start:end], dark[start:end], out=block, dtype=np.float32)
+        np.multiply(block, factor[start:end], out=block)
+
+    starts = range(0, rows, step)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            # list() so an exception on a worker is raised here
+            list(pool.map(correct, starts))
+    else:
+        for start in starts:
+            correct(start)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+# common wavelength grid every detector row is resampled onto, nm
+SPECTRAL_GRID = (450, 950, 1)
+
+def spectralGrid(low=SPECTRAL_GRID[0], high=SPECTRAL_GRID[1], step=SPECTRAL_GRID[2]):
+    return np.arange(low, high + step / 2, step, dtype=np.float64)
+
+'''
+Sparse operator taking one frame, flattened as rows*columns, to rows*len(grid)
+samples on the wavelength grid. coefficients[r] is the polynomial (highest power
+first, as np.polyval) giving row r's wavelength at a detector column. Each target
+wavelength is linearly interpolated from the two columns around it, so the
+operator is block diagonal with two entries per output sample; wavelengths a row
+doesn't cover are left at 0.
+'''
+def resamplingOperator(coefficients, columns, grid):
+    from scipy import sparse
+    coefficients = np.asarray(coefficients, np.float64)
+    rows, targets = coefficients.shape[0], len(grid)
+    pixel = np.arange(columns, dtype=np.float64)
+    outIndex, inIndex, weights = [], [], []
+    for r in range(rows):
+        wavelength = np.polyval(coefficients[r], pixel)
+        order = np.argsort(wavelength)
+        # fractional detector column of each grid wavelength
+        position = np.interp(grid, wavelength[order], pixel[order], left=np.nan, right=np.nan)
+        valid = np.flatnonzero(~np.isnan(position))
+        position = position[valid]
+        lower = np.minimum(np.floor(position).astype(np.int64), columns - 1)
+        upper = np.minimum(lower + 1, columns - 1)
+        w = (position - lower).astype(np.float32)
+        outIndex += [r * targets + valid, r * targets + valid]
+        inIndex += [r * columns + lower, r * columns + upper]
+        weights += [1 - w, w]
+    return sparse.csr_matrix((np.concatenate(weights), (np.concatenate(outIndex), np.concatenate(inIndex))),
+                             shape=(rows * targets, rows * columns), dtype=np.float32)
+
+'''
+resamplingOperator for the calibration file, compiled once and cached next to it
+(spectralCal.npy -> spectralCal_450-950-1nm.npz). The cache is rebuilt if the
+calibration file is newer or the detector width changed.
+'''
+def loadResamplingOperator(calibrationPath, columns, grid=SPECTRAL_GRID):
+    from scipy import sparse
+    low, high, step = grid
+    cachePath = f'{os.path.splitext(calibrationPath)[0]}_{low:g}-{high:g}-{step:g}nm.npz'
+    if os.path.exists(cachePath) and os.path.getmtime(cachePath) >= os.path.getmtime(calibrationPath):
+        operator = sparse.load_npz(cachePath).tocsr()
+        # rows*targets x rows*columns
+        if operator.shape[1] * len(spectralGrid(*grid)) == operator.shape[0] * columns:
+            return operator
+    coefficients = np.load(calibrationPath)
+    operator = resamplingOperator(coefficients, columns, spectralGrid(*grid))
+    sparse.save_npz(cachePath, operator)
+    return operator
+
+'''
+Applies a resamplingOperator to a [rows, frames, columns] cube as one sparse
+product over all frames at once, returning [rows, frames, len(grid)] float32
+'''
+def spectralResample(cube, operator):
+    rows, frames, columns = cube.shape
+    targets = operator.shape[0] // rows
+    # rows*columns x frames, so each frame is one column of the product
+    stacked = np.ascontiguousarray(np.transpose(cube, (0, 2, 1)), dtype=np.float32).reshape(rows * columns, frames)
+    result = np.asarray(operator @ stacked).reshape(rows, targets, frames)
+    return np.ascontiguousarray(np.transpose(result, (0, 2, 1)))
 
 class HyperSpectralCube():
-    def __init__(self, parent=None, img):
+    def __init__(self, img, dark=None, integrationTime=None, pixelFormat=None, store=None, parent=None):
         self.img = img
+        # darks from this scan, otherwise the store's for the integration time
+        self.dark = dark
+        self.integrationTime = integrationTime
+        self.pixelFormat = pixelFormat
+        if store is None:
+            import calibration
+            store = calibration.getStore()
+        self.store = store
+        self.index = None
+        self.final = None
+        self.anomalies = None
+        # bands the anomaly scores were computed over, for their threshold
+        self.anomalyBands = None
+        self.matches = None
+        # wavelength of each band of final, set by apply_spectral_mapping
+        self.wavelengths = None
 
-    def apply_spectral_mapping():
+    '''
+    Resamples the radiance cube (or the raw one before radiometric calibration)
+    onto SPECTRAL_GRID using the operator compiled from spectralCal.npy
+    (kept in the calibration store between scenes)
+    '''
+    def apply_spectral_mapping(self):
         try:
-            file = open('spectralCal.npy')
+            cube = self.img if getattr(self, 'up', None) is None else self.up
+            operator = self.store.resamplingOperator(cube.shape[2])
             '''
             apply the mapping such that we get something where
             each pixel row gets the spectralCal application,
@@ -18,13 +237,21 @@ class HyperSpectralCube():
             so we have an input of [544, frames, 764]
             apply for each frame in frames
             '''
+            self.wavelengths = spectralGrid()
+            return spectralResample(cube, operator)
         except FileNotFoundError:
             return
 
-    def apply_radiometric_mapping():
+    '''
+    Radiance cube from the raw one, out as in radiometricCorrect (a .npy path
+    keeps a cube larger than RAM on disk)
+    '''
+    def apply_radiometric_mapping(self, out=None):
         try:
-            file = open('initialDarks.npy')
-            file = open('radioCal.npy')
+            dark = self.dark
+            if dark is None:
+                dark = self.store.dark(self.integrationTime, self.pixelFormat)
+            gain = self.store.gain(self.integrationTime, self.pixelFormat)
             '''
             apply the mapping such that we get something where each pixel
             value read is converted based on radio and then has irradiance
@@ -36,43 +263,140 @@ class HyperSpectralCube():
             so we have an input of [544, frames, 764]
             apply for each frame in frames
             '''
+            return radiometricCorrect(self.img, dark, gain, out=out)
         except FileNotFoundError:
             return
 
-    def scene_calibration():
-        self.up = apply_radiometric_mapping()
-        self.final = apply_spectral_mapping()
+    def scene_calibration(self):
+        self.up = self.apply_radiometric_mapping()
+        self.final = self.apply_spectral_mapping()
         '''
         I want this final to be a [y_pixel, frames, 450-950 irradiance values]
         '''
-        for i in range (10):
-            (m,c) = kmeans(self.final, i, 30)
-            # need to do the thing where I graph the things to determine which
-            # one works
+        # every class count from one shared sample in parallel, each k warm
+        # started from k-1, sweep keeps the scores to graph which one works
+        cube = self.img if self.final is None else self.final
+        self.sweep = clustering.kmeansSweep(cube, range(2, 11), 30)
+        classCount = clustering.bestCount(self.sweep)
+        labels, sums, counts, inertia = clustering.assignAll(clustering.flattenPixels(cube),
+                                                             self.sweep[classCount]['centers'])
+        self.m = labels.reshape(cube.shape[:-1])
+        self.classes = self.sweep[classCount]['centers']
+
+    '''
+    The cube projected onto components PCA or MNF components. For a calibrated
+    cube the transform is fitted once per calibration and kept by the
+    calibration store; a raw cube depends on its exposure, so it gets its own.
+    '''
+    def reduce(self, components=20, method='mnf'):
+        if self.final is None:
+            import reduction
+            cube = self.img
+            self.reduction = reduction.fitReduction(cube, components, method)
+        else:
+            cube = self.final
+            self.reduction = self.store.reduction(cube, components, method)
+        return self.reduction.transform(cube)
 
-    def classify():
+    def classify(self, components=20):
         classCount = 20 # update classCount
-        (m, c) = kmeans(self.img, classCount, 30)
+        # mini-batch k-means in float32 over all cores, same (m, c) as spectral.kmeans,
+        # on ~20 MNF components instead of every band unless components is None
+        if components is None:
+            (m, c) = clustering.kmeans(self.img if self.final is None else self.final, classCount, 30)
+        else:
+            (m, c) = clustering.kmeans(self.reduce(components), classCount, 30)
+            # centers back to spectra
+            c = self.reduction.inverse(c)
         # where classes is an array of each classes irradiance measurements
         self.classes = c
         self.m = m
 
         return
 
-    def getClasses():
+    '''
+    RX anomaly score of every pixel ([rows, frames]), against the whole scene or
+    with local the scan columns around it. Scored on components MNF components
+    (None for every band), which is also what makes the local variant cheap.
+    '''
+    def detectAnomalies(self, components=20, local=False, window=15):
+        cube = self.img if self.final is None else self.final
+        if components is not None:
+            cube = self.reduce(components)
+        self.anomalyBands = cube.shape[2]
+        if local:
+            self.anomalies = detection.localRXScores(cube, window)
+        else:
+            self.anomalies = detection.RXDetector.fit(cube).score(cube)
+        return self.anomalies
+
+    '''
+    Best match in library (library x bands spectra, the class centers when None)
+    and its score for every pixel, with the spectral angle mapper ('sam') or the
+    adaptive matched filter ('amf') against the scene background
+    '''
+    def matchLibrary(self, library=None, method='sam'):
+        cube = self.img if self.final is None else self.final
+        if library is None:
+            library = self.classes
+        background = detection.RXDetector.fit(cube) if method == 'amf' else None
+        self.matches = detection.LibraryMatcher(library, method, background).match(cube)
+        return self.matches
+
+    def getClasses(self):
         return self.classes
 
-    def getRegularImage():
+    def getRegularImage(self):
         return self.final
 
-    def getRedImage():
-        return
+    # the calibrated cube, setting it drops the band index built over the old one
+    @property
+    def final(self):
+        return self._final
 
-    def getBlueImage():
-        return
+    @final.setter
+    def final(self, cube):
+        self._final = cube
+        self.index = None
 
-    def getGreenImage():
-        return
+    '''
+    Band index over the calibrated cube if there is one, else the raw cube,
+    built on first use
+    '''
+    def bandIndex(self):
+        if self.index is None:
+            if self.final is None:
+                self.index = BandIndex(self.img)
+            else:
+                self.index = BandIndex(self.final, self.wavelengths)
+        return self.index
 
-    def getIRImage():
-        return
+    def getBandImage(self, start, end):
+        return self.bandIndex().mean(start, end)
+
+    '''
+    Mean image of a display band ('blue', 'green', 'red' or 'ir'): over its
+    detector columns for the raw cube, over its wavelengths once the cube has
+    been resampled onto the wavelength grid
+    '''
+    def getBand(self, band):
+        index = self.bandIndex()
+        if index.wavelengths is None:
+            return index.mean(*BAND_RANGES[band])
+        return index.wavelengthMean(*BAND_WAVELENGTHS[band])
+
+    def getRedImage(self):
+        return self.getBand('red')
+
+    def getBlueImage(self):
+        return self.getBand('blue')
+
+    def getGreenImage(self):
+        return self.getBand('green')
+
+    def getIRImage(self):
+        return self.getBand('ir')
+
+    # blue, green, red, ir band means stacked on the last axis
+    def getCompositeImage(self):
+        return np.stack([self.getBand(b) for b in ('blue', 'green', 'red', 'ir')], axis=2)
@@ -0,0 +1,123 @@
+'''
+Dimensionality reduction (PCA / MNF) of hyperspectral cubes ahead of
+clustering and anomaly scoring
+'''
+
+import numpy as np
+
+# rows of the cube per chunk while accumulating or projecting
+CHUNK_ROWS = 32
+
+class CovarianceAccumulator:
+    '''
+    Mean and covariance of spectra built up one chunk of pixels at a time, so a
+    memory-mapped cube is read once and never held in memory. Chunks are
+    centred on the first chunk's mean before their float32 product is added to
+    float64 totals, which keeps the usual sum of squares cancellation away.
+    '''
+    def __init__(self, bands) -> None:
+        self.count = 0
+        self.shift = None
+        self.sum = np.zeros(bands, np.float64)
+        self.products = np.zeros((bands, bands), np.float64)
+
+    def add(self, pixels) -> None:
+        x = np.asarray(pixels, np.float32).reshape(-1, self.sum.shape[0])
+        if len(x) == 0:
+            return
+        if self.shift is None:
+            self.shift = x.mean(axis=0)
+        x = x - self.shift
+        self.count += len(x)
+        self.sum += x.sum(axis=0, dtype=np.float64)
+        self.products += x.T @ x
+
+    def mean(self):
+        return self.shift + self.sum / self.count
+
+    def covariance(self):
+        centred = self.sum / self.count
+        return self.products / self.count - np.outer(centred, centred)
+
+'''
+Streams a [rows, frames, bands] cube once for the spectra covariance and, for
+MNF, the noise covariance estimated from the difference of neighbouring pixels
+along the scan (half the variance of the difference is the noise variance when
+neighbours see nearly the same scene)
+'''
+def cubeStatistics(cube, noise=False):
+    rows, frames, bands = cube.shape
+    signal = CovarianceAccumulator(bands)
+    difference = CovarianceAccumulator(bands) if noise and frames > 1 else None
+    for start in range(0, rows, CHUNK_ROWS):
+        block = np.asarray(cube[start:start + CHUNK_ROWS], np.float32)
+        signal.add(block)
+        if difference is not None:
+            difference.add(block[:, 1:, :] - block[:, :-1, :])
+    noiseCovariance = None if difference is None else difference.covariance() / 2
+    return signal.mean(), signal.covariance(), noiseCovariance
+
+class Reduction:
+    '''
+    Linear projection of spectra onto a few components, out = (x - mean) @ matrix.
+    PCA keeps the directions of largest variance. MNF (minimum noise fraction)
+    first whitens the noise so the components are ordered by signal to noise
+    instead, which keeps noisy bands from dominating. inverse maps component
+    space points (e.g. cluster centers) back to spectra.
+    '''
+    def __init__(self, mean, matrix, method='pca') -> None:
+        self.mean = np.asarray(mean, np.float32)
+        self.matrix = np.asarray(matrix, np.float32)
+        self.method = method
+        self.offset = self.mean @ self.matrix
+        self.inverseMatrix = np.linalg.pinv(self.matrix).astype(np.float32)
+
+    @property
+    def components(self) -> int:
+        return self.matrix.shape[1]
+
+    '''
+    Projects a [rows, frames, bands] cube to [rows, frames, components] float32,
+    a chunk of rows at a time into out (a new array when None)
+    '''
+    def transform(self, cube, out=None):
+        rows, frames, bands = cube.shape
+        if out is None:
+            out = np.empty((rows, frames, self.components), np.float32)
+        for start in range(0, rows, CHUNK_ROWS):
+            block = np.asarray(cube[start:start + CHUNK_ROWS], np.float32).reshape(-1, bands)
+            projected = block @ self.matrix
+            projected -= self.offset
+            out[start:start + CHUNK_ROWS] = projected.reshape(-1, frames, self.components)
+        return out
+
+    def inverse(self, points):
+        return np.asarray(points, np.float32) @ self.inverseMatrix + self.mean
+
+    def save(self, path) -> None:
+        np.savez(path, mean=self.mean, matrix=self.matrix, method=self.method)
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        return Reduction(data['mean'], data['matrix'], str(data['method']))
+
+'''
+Fits a PCA or MNF Reduction to components components in one pass over cube
+'''
+def fitReduction(cube, components=20, method='mnf'):
+    from scipy import linalg
+    if method not in ('pca', 'mnf'):
+        raise ValueError('Unknown reduction method: ' + method)
+    mean, covariance, noise = cubeStatistics(cube, noise=method == 'mnf')
+    bands = covariance.shape[0]
+    components = min(components, bands)
+    if noise is None:
+        # eigh sorts ascending, so the last eigenvectors carry the most variance
+        values, vectors = linalg.eigh(covariance, subset_by_index=(bands - components, bands - 1))
+        method = 'pca'
+    else:
+        # a little ridge keeps the noise covariance invertible for dead bands
+        noise += np.eye(bands) * (np.trace(noise) / bands * 1e-6 + 1e-12)
+        values, vectors = linalg.eigh(covariance, noise, subset_by_index=(bands - components, bands - 1))
+    return Reduction(mean, vectors[:, ::-1], method)
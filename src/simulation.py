@@ -0,0 +1,455 @@
+'''
+Hardware-free stand-ins for the camera and the stepper's Arduino, so the
+acquisition path can be run and timed without the rig. Select them with
+SPECTROMETER_BACKEND=sim or Camera.setBackend('sim') / DM542t.setBackend('sim').
+'''
+
+import math
+import struct
+import threading
+import time
+import numpy as np
+from vmbpy import FrameStatus, PixelFormat, VmbFeatureError
+from Camera import CameraSession
+from acquisition import MONO12P_LAYOUT, MONO10P_LAYOUT
+from DM542t import DM542t
+
+PACKED_LAYOUTS = {
+    PixelFormat.Mono12p: (3, MONO12P_LAYOUT),
+    PixelFormat.Mono10p: (5, MONO10P_LAYOUT),
+}
+
+# packs uint16 pixels into GenICam LSB packed bytes, the inverse of acquisition.unpackPacked
+def packPixels(pixels, groupBytes, layout):
+    pixels = pixels.reshape(-1, len(layout))
+    groups = np.zeros((pixels.shape[0], groupBytes), np.uint8)
+    for k, (low, lowShift, high, highMask, highShift) in enumerate(layout):
+        p = pixels[:, k]
+        groups[:, low] |= ((p << lowShift) & 0xFF).astype(np.uint8)
+        groups[:, high] |= ((p >> highShift) & highMask).astype(np.uint8)
+    return groups.reshape(-1)
+
+class SimulatedFeature:
+    '''
+    Camera feature with a value, a range and an increment, set() clamps and
+    snaps like the real camera does
+    '''
+    def __init__(self, name, value, low=None, high=None, increment=None, onSet=None) -> None:
+        self.name = name
+        self.value = value
+        self.low = low
+        self.high = high
+        self.increment = increment
+        self.onSet = onSet
+
+    def get_name(self) -> str:
+        return self.name
+
+    def get(self):
+        return self.value
+
+    def set(self, value) -> None:
+        if self.low is not None:
+            value = min(max(value, self.low), self.high)
+            if self.increment:
+                value = self.low + round((value - self.low) / self.increment) * self.increment
+        self.value = value
+        if self.onSet is not None:
+            self.onSet()
+
+    def get_range(self) -> tuple:
+        return (self.low, self.high)
+
+    def get_increment(self):
+        return self.increment
+
+class SimulatedFrame:
+    def __init__(self, pixels, pixelFormat, timestamp) -> None:
+        self.pixels = pixels
+        self.pixelFormat = pixelFormat
+        self.timestamp = timestamp
+
+    def get_status(self):
+        return FrameStatus.Complete
+
+    def get_pixel_format(self):
+        return self.pixelFormat
+
+    # camera clock in nanoseconds
+    def get_timestamp(self) -> int:
+        return self.timestamp
+
+    def get_height(self) -> int:
+        return self.pixels.shape[0]
+
+    def get_width(self) -> int:
+        return self.pixels.shape[1]
+
+    def get_buffer(self):
+        if self.pixelFormat in PACKED_LAYOUTS:
+            groupBytes, layout = PACKED_LAYOUTS[self.pixelFormat]
+            return packPixels(self.pixels, groupBytes, layout).tobytes()
+        return self.pixels.tobytes()
+
+    def as_numpy_ndarray(self):
+        if self.pixelFormat in PACKED_LAYOUTS:
+            raise ValueError('Packed pixel formats can not be converted to an ndarray')
+        return self.pixels
+
+    def as_opencv_image(self):
+        return self.as_numpy_ndarray()
+
+class SimulatedCamera:
+    '''
+    Synthetic sensor. Frames are a fixed spectral pattern scaled by the
+    exposure time (brightness is counts per microsecond at full pattern) plus a
+    dark level and noise, clipped to the pixel format's range. Frames come at
+    the slower of frameRate and 1/exposure, from get_frame() or streamed to a
+    handler on a background thread like vmbpy's start_streaming.
+    '''
+    def __init__(self, sensorWidth=764, sensorHeight=544, frameRate=100.0, brightness=0.5,
+                 dark=40, noise=4.0) -> None:
+        self.frameRate = frameRate
+        self.brightness = brightness
+        self.dark = dark
+        self.pixelFormat = PixelFormat.Mono12
+        self.features = {}
+        for feature in (SimulatedFeature('ExposureTime', 5000.0, 30.0, 10000000.0, 1.0),
+                        SimulatedFeature('Gain', 0.0, 0.0, 24.0, 0.1),
+                        SimulatedFeature('GainAuto', False),
+                        SimulatedFeature('Width', sensorWidth, 8, sensorWidth, 8),
+                        SimulatedFeature('Height', sensorHeight, 8, sensorHeight, 8),
+                        SimulatedFeature('OffsetX', 0, 0, sensorWidth - 8, 8),
+                        SimulatedFeature('OffsetY', 0, 0, sensorHeight - 8, 8),
+                        SimulatedFeature('BinningHorizontal', 1, 1, 4, 1, self.binningChanged),
+                        SimulatedFeature('BinningVertical', 1, 1, 4, 1, self.binningChanged)):
+            self.features[feature.get_name()] = feature
+        self.sensorWidth = sensorWidth
+        self.sensorHeight = sensorHeight
+        # spectral pattern: a smooth spectrum along the columns, falling off towards the edge rows
+        columns = np.linspace(0, 1, sensorWidth)
+        rows = np.linspace(-1, 1, sensorHeight)
+        spectrum = np.exp(-((columns - 0.45) / 0.25) ** 2)
+        self.pattern = (np.outer(1 - 0.5 * rows ** 2, spectrum)).astype(np.float32)
+        rng = np.random.default_rng(0)
+        self.noise = rng.normal(0, noise, (4, sensorHeight, sensorWidth)).astype(np.float32)
+        self.frameCount = 0
+        self.handler = None
+        self.streamThread = None
+        self.streaming = False
+        self.epoch = time.monotonic()
+
+    def __getattr__(self, name):
+        # cam.ExposureTime style access, like vmbpy
+        features = self.__dict__.get('features', {})
+        if name in features:
+            return features[name]
+        raise AttributeError(name)
+
+    # binning shrinks the sensor, so the ROI limits follow it like on the camera
+    def binningChanged(self) -> None:
+        f = self.features
+        for size, offset, sensor, binning in (('Width', 'OffsetX', self.sensorWidth, 'BinningHorizontal'),
+                                              ('Height', 'OffsetY', self.sensorHeight, 'BinningVertical')):
+            high = sensor // f[binning].get()
+            high -= high % 8
+            f[size].high = high
+            f[size].value = min(f[size].value, high)
+            f[offset].high = high - 8
+            f[offset].value = min(f[offset].value, high - f[size].value)
+
+    def get_feature_by_name(self, name):
+        if name not in self.features:
+            raise VmbFeatureError('Feature not found: ' + name)
+        return self.features[name]
+
+    def get_all_features(self) -> tuple:
+        return tuple(self.features.values())
+
+    def get_pixel_formats(self) -> tuple:
+        return (PixelFormat.Mono8, PixelFormat.Mono10, PixelFormat.Mono10p,
+                PixelFormat.Mono12, PixelFormat.Mono12p)
+
+    def get_pixel_format(self):
+        return self.pixelFormat
+
+    def set_pixel_format(self, pixelFormat) -> None:
+        self.pixelFormat = pixelFormat
+
+    def framePeriod(self) -> float:
+        return max(1.0 / self.frameRate, self.features['ExposureTime'].get() / 1e6)
+
+    def maxValue(self) -> int:
+        if self.pixelFormat == PixelFormat.Mono8:
+            return 255
+        if self.pixelFormat in (PixelFormat.Mono10, PixelFormat.Mono10p):
+            return 1023
+        return 4095
+
+    # exposureEnd is when the exposure ended on the sensor clock, now if not given
+    def makeFrame(self, exposureEnd=None) -> SimulatedFrame:
+        f = self.features
+        binX, binY = f['BinningHorizontal'].get(), f['BinningVertical'].get()
+        x, y = f['OffsetX'].get() * binX, f['OffsetY'].get() * binY
+        w, h = f['Width'].get() * binX, f['Height'].get() * binY
+        scale = self.brightness * f['ExposureTime'].get() * binX * binY
+        frame = self.pattern[y:y + h, x:x + w] * scale
+        frame += self.noise[self.frameCount % len(self.noise), y:y + h, x:x + w]
+        frame += self.dark
+        if binX > 1 or binY > 1:
+            frame = frame[:h - h % binY, :w - w % binX]
+            frame = frame.reshape(h // binY, binY, w // binX, binX).sum(axis=(1, 3)) / (binX * binY)
+        np.clip(frame, 0, self.maxValue(), out=frame)
+        dtype = np.uint8 if self.pixelFormat == PixelFormat.Mono8 else np.uint16
+        pixels = frame.astype(dtype)[:, :, np.newaxis]
+        self.frameCount += 1
+        # stamped at the start of exposure like the camera does
+        if exposureEnd is None:
+            exposureEnd = time.monotonic()
+        exposureStart = exposureEnd - f['ExposureTime'].get() / 1e6
+        timestamp = int((exposureStart - self.epoch) * 1e9)
+        return SimulatedFrame(pixels, self.pixelFormat, timestamp)
+
+    def get_frame(self, timeout_ms=2000) -> SimulatedFrame:
+        time.sleep(self.framePeriod())
+        return self.makeFrame()
+
+    def start_streaming(self, handler, buffer_count=5, allocation_mode=None) -> None:
+        self.handler = handler
+        self.streaming = True
+        self.streamThread = threading.Thread(target=self.stream, daemon=True)
+        self.streamThread.start()
+
+    # exposures run on the sensor's own clock, only their delivery is late when
+    # this thread is; frames that couldn't be delivered in time are lost
+    def stream(self) -> None:
+        due = time.monotonic()
+        while self.streaming:
+            period = self.framePeriod()
+            due += period
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif -delay > period:
+                due += math.floor(-delay / period) * period
+            if self.streaming:
+                self.handler(self, None, self.makeFrame(due))
+
+    def queue_frame(self, frame) -> None:
+        pass
+
+    def stop_streaming(self) -> None:
+        self.streaming = False
+        if self.streamThread is not None:
+            self.streamThread.join()
+            self.streamThread = None
+
+    def is_streaming(self) -> bool:
+        return self.streaming
+
+class SimulatedSession(CameraSession):
+    '''
+    CameraSession backed by a SimulatedCamera, keyword arguments go to the camera
+    '''
+    def __init__(self, **cameraOptions) -> None:
+        super().__init__()
+        self.cameraOptions = cameraOptions
+
+    def open(self):
+        if self.cam is None:
+            self.cam = SimulatedCamera(**self.cameraOptions)
+        return self.cam
+
+    def close(self) -> None:
+        self.features = {}
+        if self.cam is not None:
+            self.cam.stop_streaming()
+            self.cam = None
+
+class SimulatedSerial:
+    '''
+    Stands in for the Arduino driving the DM542t. Understands the same 2 byte
+    signed short commands (a step count, or 0 to go back home) and answers each
+    one once the move would have finished. A move takes latency (USB + firmware
+    turnaround) plus stepDelay per step plus settle. Also runs scan plans
+    (DM542t.startPlan) with per-position "A<i>" reports and early releases,
+    constant velocity sweeps (DM542t.startSweep) and aborts. The moves of a plan
+    after the first are the controller's own, so they don't pay latency, but a
+    release does. Supports the pyserial calls the driver uses, including
+    blocking read() with timeout.
+    '''
+    def __init__(self, latency=0.002, stepDelay=0.0018, settle=0.005, reply=b'done\n') -> None:
+        self.latency = latency
+        self.stepDelay = stepDelay
+        self.settle = settle
+        self.reply = reply
+        self.timeout = None
+        self.position = 0
+        self.pending = b''
+        # (time the bytes become readable, bytes)
+        self.replies = []
+        self.busyUntil = time.monotonic()
+        self.lock = threading.Condition()
+        self.is_open = True
+        # steps between reports of the running plan, its dwell and arrival times,
+        # and the running sweep (start time, steps, step rate) if there is one
+        self.planSteps = 0
+        self.planDwell = 0
+        self.planArrivals = []
+        self.sweeping = None
+
+    def moveTime(self, steps) -> float:
+        return self.latency + abs(steps) * self.stepDelay + self.settle
+
+    def write(self, data) -> int:
+        with self.lock:
+            self.pending += bytes(data)
+            while len(self.pending) >= 2:
+                steps = struct.unpack('h', self.pending[:2])[0]
+                if steps == DM542t.PlanCommand:
+                    if len(self.pending) < 10:
+                        break
+                    self.plan(*struct.unpack('hhHH', self.pending[2:10]))
+                    self.pending = self.pending[10:]
+                    continue
+                if steps == DM542t.ReleaseCommand:
+                    if len(self.pending) < 6:
+                        break
+                    self.release(*struct.unpack('hH', self.pending[2:6]))
+                    self.pending = self.pending[6:]
+                    continue
+                if steps == DM542t.SweepCommand:
+                    if len(self.pending) < 6:
+                        break
+                    self.sweep(*struct.unpack('hH', self.pending[2:6]))
+                    self.pending = self.pending[6:]
+                    continue
+                self.pending = self.pending[2:]
+                if steps == DM542t.AbortCommand:
+                    self.abort()
+                else:
+                    self.command(steps)
+            self.lock.notify_all()
+        return len(data)
+
+    def command(self, steps) -> None:
+        # 0 sends the motor home
+        if steps == 0:
+            steps = -self.position
+        self.position += steps
+        start = max(time.monotonic(), self.busyUntil)
+        self.busyUntil = start + self.moveTime(steps)
+        self.replies.append((self.busyUntil, self.reply))
+
+    def plan(self, startSteps, stepsPerImage, images, dwellMs) -> None:
+        t = max(time.monotonic(), self.busyUntil) + self.moveTime(startSteps)
+        self.position += startSteps
+        self.planDwell = dwellMs / 1000
+        self.planArrivals = []
+        for i in range(images):
+            self.replies.append((t, b'A' + str(i).encode() + b'\n'))
+            self.planArrivals.append(t)
+            if i < images - 1:
+                t += self.planDwell + self.moveTime(stepsPerImage) - self.latency
+                self.position += stepsPerImage
+        self.replies.append((t, b'D\n'))
+        self.busyUntil = t
+        self.planSteps = stepsPerImage
+
+    # cuts the dwell at plan position index to leaveMs, everything after it moves up
+    def release(self, index, leaveMs) -> None:
+        now = time.monotonic() + self.latency
+        if not 0 <= index < len(self.planArrivals) - 1:
+            return
+        arrival = self.planArrivals[index]
+        leave = arrival + self.planDwell
+        # too late, the controller is already on its way
+        if now >= leave:
+            return
+        shift = leave - max(now, arrival + leaveMs / 1000)
+        if shift <= 0:
+            return
+        self.replies = [(t - shift if t > arrival else t, r) for t, r in self.replies]
+        self.planArrivals[index + 1:] = [t - shift for t in self.planArrivals[index + 1:]]
+        self.busyUntil -= shift
+
+    def sweep(self, steps, stepRate) -> None:
+        t = max(time.monotonic(), self.busyUntil) + self.latency
+        self.replies.append((t, b'A0\n'))
+        self.busyUntil = t + abs(steps) / stepRate
+        self.replies.append((self.busyUntil, b'D\n'))
+        self.position += steps
+        self.sweeping = (t, steps, stepRate)
+        self.planSteps = 0
+        self.planArrivals = []
+
+    def abort(self) -> None:
+        now = time.monotonic()
+        # moves that had not been reported yet never happen
+        unreported = sum(1 for t, r in self.replies if t > now and r.startswith(b'A'))
+        self.position -= unreported * self.planSteps
+        if self.sweeping is not None:
+            start, steps, stepRate = self.sweeping
+            if self.busyUntil > now:
+                moved = min(max((now - start) * stepRate, 0), abs(steps))
+                self.position -= steps - int(math.copysign(moved, steps))
+            self.sweeping = None
+        self.replies = [(t, r) for t, r in self.replies if t <= now]
+        self.planArrivals = []
+        self.busyUntil = now + self.latency
+        self.replies.append((self.busyUntil, b'D\n'))
+
+    def readline(self) -> bytes:
+        line = b''
+        while not line.endswith(b'\n'):
+            c = self.read(1)
+            if not c:
+                break
+            line += c
+        return line
+
+    def ready(self) -> bytes:
+        now = time.monotonic()
+        data = b''
+        while self.replies and self.replies[0][0] <= now:
+            data += self.replies.pop(0)[1]
+        if data:
+            self.replies.insert(0, (now, data))
+        return data
+
+    def inWaiting(self) -> int:
+        with self.lock:
+            return len(self.ready())
+
+    @property
+    def in_waiting(self) -> int:
+        return self.inWaiting()
+
+    def read(self, size=1) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        out = b''
+        with self.lock:
+            while len(out) < size:
+                data = self.ready()
+                if data:
+                    take = data[:size - len(out)]
+                    out += take
+                    self.replies[0] = (self.replies[0][0], data[len(take):])
+                    if not self.replies[0][1]:
+                        self.replies.pop(0)
+                    continue
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                wake = self.replies[0][0] - now if self.replies else None
+                if deadline is not None:
+                    wake = deadline - now if wake is None else min(wake, deadline - now)
+                self.lock.wait(wake)
+        return out
+
+    def reset_input_buffer(self) -> None:
+        with self.lock:
+            self.replies = [(t, r) for t, r in self.replies if t > time.monotonic()]
+
+    def close(self) -> None:
+        self.is_open = False